@@ -114,6 +114,7 @@ override_doctype_class = {"Web Form": "payments.overrides.payment_webform.Paymen
 scheduler_events = {
 	"all": [
 		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.capture_payment",
+		"payments.payment_gateways.doctype.braintree_settings.client_token_pool.refill_client_token_pools",
 	],
 }
 
@@ -0,0 +1,16 @@
+import json
+
+import frappe
+
+from payments.payment_gateways.doctype.razorpay_pending_capture.razorpay_pending_capture import (
+	add_pending_capture,
+)
+
+
+def execute():
+	for doc in frappe.get_all(
+		"Integration Request",
+		filters={"status": "Authorized", "integration_request_service": "Razorpay"},
+		fields=["name", "data"],
+	):
+		add_pending_capture(doc.name, json.loads(doc.data))
@@ -3,158 +3,169 @@
 
 from urllib.parse import urlencode
 
-import braintree
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, get_url
 
-from payments.utils import create_payment_gateway
+from payments.payment_gateways.doctype.braintree_settings.client_token_pool import (
+	clear_pool,
+	pop_client_token,
+)
+from payments.utils import create_payment_gateway, get_gateway_details
+from payments.utils.client_cache import get_client
+from payments.utils.lazy_import import lazy_import
+from payments.utils.metrics import instrumented
+from payments.utils.settings_cache import clear_settings_cache, get_password, get_settings
+
+braintree = lazy_import("braintree")
 
 
 class BraintreeSettings(Document):
-	supported_currencies = (
-		"AED",
-		"AMD",
-		"AOA",
-		"ARS",
-		"AUD",
-		"AWG",
-		"AZN",
-		"BAM",
-		"BBD",
-		"BDT",
-		"BGN",
-		"BIF",
-		"BMD",
-		"BND",
-		"BOB",
-		"BRL",
-		"BSD",
-		"BWP",
-		"BYN",
-		"BZD",
-		"CAD",
-		"CHF",
-		"CLP",
-		"CNY",
-		"COP",
-		"CRC",
-		"CVE",
-		"CZK",
-		"DJF",
-		"DKK",
-		"DOP",
-		"DZD",
-		"EGP",
-		"ETB",
-		"EUR",
-		"FJD",
-		"FKP",
-		"GBP",
-		"GEL",
-		"GHS",
-		"GIP",
-		"GMD",
-		"GNF",
-		"GTQ",
-		"GYD",
-		"HKD",
-		"HNL",
-		"HRK",
-		"HTG",
-		"HUF",
-		"IDR",
-		"ILS",
-		"INR",
-		"ISK",
-		"JMD",
-		"JPY",
-		"KES",
-		"KGS",
-		"KHR",
-		"KMF",
-		"KRW",
-		"KYD",
-		"KZT",
-		"LAK",
-		"LBP",
-		"LKR",
-		"LRD",
-		"LSL",
-		"LTL",
-		"MAD",
-		"MDL",
-		"MKD",
-		"MNT",
-		"MOP",
-		"MUR",
-		"MVR",
-		"MWK",
-		"MXN",
-		"MYR",
-		"MZN",
-		"NAD",
-		"NGN",
-		"NIO",
-		"NOK",
-		"NPR",
-		"NZD",
-		"PAB",
-		"PEN",
-		"PGK",
-		"PHP",
-		"PKR",
-		"PLN",
-		"PYG",
-		"QAR",
-		"RON",
-		"RSD",
-		"RUB",
-		"RWF",
-		"SAR",
-		"SBD",
-		"SCR",
-		"SEK",
-		"SGD",
-		"SHP",
-		"SLL",
-		"SOS",
-		"SRD",
-		"STD",
-		"SVC",
-		"SYP",
-		"SZL",
-		"THB",
-		"TJS",
-		"TOP",
-		"TRY",
-		"TTD",
-		"TWD",
-		"TZS",
-		"UAH",
-		"UGX",
-		"USD",
-		"UYU",
-		"UZS",
-		"VEF",
-		"VND",
-		"VUV",
-		"WST",
-		"XAF",
-		"XCD",
-		"XOF",
-		"XPF",
-		"YER",
-		"ZAR",
-		"ZMK",
-		"ZWD",
+	supported_currencies = frozenset(
+		(
+			"AED",
+			"AMD",
+			"AOA",
+			"ARS",
+			"AUD",
+			"AWG",
+			"AZN",
+			"BAM",
+			"BBD",
+			"BDT",
+			"BGN",
+			"BIF",
+			"BMD",
+			"BND",
+			"BOB",
+			"BRL",
+			"BSD",
+			"BWP",
+			"BYN",
+			"BZD",
+			"CAD",
+			"CHF",
+			"CLP",
+			"CNY",
+			"COP",
+			"CRC",
+			"CVE",
+			"CZK",
+			"DJF",
+			"DKK",
+			"DOP",
+			"DZD",
+			"EGP",
+			"ETB",
+			"EUR",
+			"FJD",
+			"FKP",
+			"GBP",
+			"GEL",
+			"GHS",
+			"GIP",
+			"GMD",
+			"GNF",
+			"GTQ",
+			"GYD",
+			"HKD",
+			"HNL",
+			"HRK",
+			"HTG",
+			"HUF",
+			"IDR",
+			"ILS",
+			"INR",
+			"ISK",
+			"JMD",
+			"JPY",
+			"KES",
+			"KGS",
+			"KHR",
+			"KMF",
+			"KRW",
+			"KYD",
+			"KZT",
+			"LAK",
+			"LBP",
+			"LKR",
+			"LRD",
+			"LSL",
+			"LTL",
+			"MAD",
+			"MDL",
+			"MKD",
+			"MNT",
+			"MOP",
+			"MUR",
+			"MVR",
+			"MWK",
+			"MXN",
+			"MYR",
+			"MZN",
+			"NAD",
+			"NGN",
+			"NIO",
+			"NOK",
+			"NPR",
+			"NZD",
+			"PAB",
+			"PEN",
+			"PGK",
+			"PHP",
+			"PKR",
+			"PLN",
+			"PYG",
+			"QAR",
+			"RON",
+			"RSD",
+			"RUB",
+			"RWF",
+			"SAR",
+			"SBD",
+			"SCR",
+			"SEK",
+			"SGD",
+			"SHP",
+			"SLL",
+			"SOS",
+			"SRD",
+			"STD",
+			"SVC",
+			"SYP",
+			"SZL",
+			"THB",
+			"TJS",
+			"TOP",
+			"TRY",
+			"TTD",
+			"TWD",
+			"TZS",
+			"UAH",
+			"UGX",
+			"USD",
+			"UYU",
+			"UZS",
+			"VEF",
+			"VND",
+			"VUV",
+			"WST",
+			"XAF",
+			"XCD",
+			"XOF",
+			"XPF",
+			"YER",
+			"ZAR",
+			"ZMK",
+			"ZWD",
+		)
 	)
 
 	def validate(self):
 		if not self.flags.ignore_mandatory:
-			self.configure_braintree()
+			self.make_gateway(self.get_password(fieldname="private_key", raise_exception=False))
 
 	def on_update(self):
 		create_payment_gateway(
@@ -163,18 +174,36 @@ class BraintreeSettings(Document):
 			controller=self.gateway_name,
 		)
 		call_hook_method("payment_gateway_enabled", gateway="Braintree-" + self.gateway_name)
+		clear_settings_cache(self)
+		clear_pool(self.name)
+
+	def on_trash(self):
+		clear_settings_cache(self)
+		clear_pool(self.name)
+
+	def get_gateway(self):
+		"""Return the gateway of this account, rebuilt when the credentials change.
 
-	def configure_braintree(self):
+		The global `braintree.Configuration` is never used, so several accounts can be used
+		concurrently.
+		"""
+		private_key = get_password(self, "private_key")
+		credentials = (self.use_sandbox, self.merchant_id, self.public_key, private_key)
+		return get_client("braintree", self.name, credentials, lambda: self.make_gateway(private_key))
+
+	def make_gateway(self, private_key):
 		if self.use_sandbox:
 			environment = "sandbox"
 		else:
 			environment = "production"
 
-		braintree.Configuration.configure(
-			environment=environment,
-			merchant_id=self.merchant_id,
-			public_key=self.public_key,
-			private_key=self.get_password(fieldname="private_key", raise_exception=False),
+		return braintree.BraintreeGateway(
+			braintree.Configuration(
+				environment=environment,
+				merchant_id=self.merchant_id,
+				public_key=self.public_key,
+				private_key=private_key,
+			)
 		)
 
 	def validate_transaction_currency(self, currency):
@@ -185,9 +214,11 @@ class BraintreeSettings(Document):
 				).format(currency)
 			)
 
+	@instrumented("braintree.get_payment_url")
 	def get_payment_url(self, **kwargs):
 		return get_url(f"./braintree_checkout?{urlencode(kwargs)}")
 
+	@instrumented("braintree.create_payment_request")
 	def create_payment_request(self, data):
 		self.data = frappe._dict(data)
 
@@ -208,12 +239,10 @@ class BraintreeSettings(Document):
 			}
 
 	def create_charge_on_braintree(self):
-		self.configure_braintree()
-
 		redirect_to = self.data.get("redirect_to") or None
 		redirect_message = self.data.get("redirect_message") or None
 
-		result = braintree.Transaction.sale(
+		result = self.get_gateway().transaction.sale(
 			{
 				"amount": self.data.amount,
 				"payment_method_nonce": self.data.payload_nonce,
@@ -278,16 +307,14 @@ class BraintreeSettings(Document):
 
 
 def get_gateway_controller(doc):
-	payment_request = frappe.get_doc("Payment Request", doc)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", payment_request.payment_gateway, "gateway_controller"
-	)
-	return gateway_controller
+	return get_gateway_details("Braintree Settings", "Payment Request", doc).gateway_controller
 
 
 def get_client_token(doc):
 	gateway_controller = get_gateway_controller(doc)
-	settings = frappe.get_doc("Braintree Settings", gateway_controller)
-	settings.configure_braintree()
+	token = pop_client_token(gateway_controller)
+	if token:
+		return token
 
-	return braintree.ClientToken.generate()
+	settings = get_settings("Braintree Settings", gateway_controller)
+	return settings.get_gateway().client_token.generate()
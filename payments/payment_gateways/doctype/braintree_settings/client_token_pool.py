@@ -0,0 +1,93 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Pool of pre-generated Braintree client tokens, one per gateway.
+
+Generating a client token is a round trip to Braintree, so checkout pages take one from a
+redis list filled in the background by `refill_client_token_pools`, and only generate one
+themselves when the pool is empty. Tokens are used for `braintree_client_token_ttl`
+seconds at most after being generated, well within their validity.
+
+Site config:
+
+	braintree_client_token_pool_size: tokens kept ready per gateway (default 20)
+	braintree_client_token_ttl: seconds a pooled token can be handed out for (default 3600)
+"""
+
+import json
+import time
+
+import frappe
+from frappe.utils import cint
+
+DEFAULT_POOL_SIZE = 20
+DEFAULT_TTL = 60 * 60
+
+
+def pop_client_token(gateway_name):
+	"""Return a pooled client token of the gateway, None if there is none left."""
+	cache = frappe.cache()
+	key = get_pool_key(gateway_name)
+
+	while raw := cache.lpop(key):
+		token = json.loads(raw)
+		if token["expires_at"] > time.time():
+			cache.incr(cache.make_key(f"{key}:hits"))
+			return token["token"]
+
+	cache.incr(cache.make_key(f"{key}:misses"))
+
+
+def refill_client_token_pools():
+	"""Top up the pool of every Braintree gateway, runs from the scheduler."""
+	from payments.utils.settings_cache import get_settings
+
+	for name in frappe.get_all("Braintree Settings", pluck="name"):
+		try:
+			refill_client_token_pool(get_settings("Braintree Settings", name))
+		except Exception:
+			frappe.log_error(f"Braintree: Failed to refill the client token pool of {name}")
+
+
+def refill_client_token_pool(settings):
+	cache = frappe.cache()
+	key = get_pool_key(settings.name)
+	pool_size = cint(frappe.conf.braintree_client_token_pool_size) or DEFAULT_POOL_SIZE
+	ttl = cint(frappe.conf.braintree_client_token_ttl) or DEFAULT_TTL
+
+	# tokens are appended as they are generated, the expired ones are at the head
+	while (head := cache.lrange(key, 0, 0)) and json.loads(head[0])["expires_at"] <= time.time():
+		cache.lpop(key)
+
+	gateway = settings.get_gateway()
+	for _ in range(pool_size - cache.llen(key)):
+		token = gateway.client_token.generate()
+		cache.rpush(key, json.dumps({"token": token, "expires_at": time.time() + ttl}))
+
+
+@frappe.whitelist()
+def get_pool_stats():
+	"""Tokens ready, hits and misses of the client token pool of every Braintree gateway."""
+	frappe.only_for("System Manager")
+
+	cache = frappe.cache()
+	stats = {}
+	for name in frappe.get_all("Braintree Settings", pluck="name"):
+		key = get_pool_key(name)
+		stats[name] = {
+			"size": cache.llen(key),
+			"hits": cint(cache.get(cache.make_key(f"{key}:hits"))),
+			"misses": cint(cache.get(cache.make_key(f"{key}:misses"))),
+		}
+
+	return stats
+
+
+def clear_pool(gateway_name):
+	"""Drop the pooled tokens, they were generated with the previous credentials."""
+	frappe.cache().delete_value(get_pool_key(gateway_name))
+
+
+def get_pool_key(gateway_name):
+	return f"braintree_client_tokens:{gateway_name}"
@@ -2,15 +2,40 @@
 # For license information, please see license.txt
 
 
-import hashlib
-import hmac
 import json
 
 import frappe
+from frappe.query_builder import Case
+from frappe.utils import now
+
+from payments.utils.metrics import instrumented
+from payments.utils.signature import is_valid_signature
+
+EVENT_TTL = 7 * 24 * 60 * 60
+ACTIVE_MANDATE_ACTIONS = ("pending_customer_approval", "pending_submission", "submitted", "active")
+# status of a mandate after an event, by action of the event
+MANDATE_STATUSES = {
+	"active": "active",
+	"reinstated": "active",
+	"submitted": "submitted",
+	"resubmission_requested": "pending_submission",
+	"suspended_by_payer": "suspended_by_payer",
+	"cancelled": "cancelled",
+	"replaced": "cancelled",
+	"failed": "failed",
+	"expired": "expired",
+	"consumed": "consumed",
+	"blocked": "blocked",
+}
 
 
 @frappe.whitelist(allow_guest=True)
+@instrumented("gocardless.webhooks")
 def webhooks():
+	"""Verify and queue a batch of events, they are processed by `process_webhook` in a background job.
+
+	A batch whose events have all been received before is acknowledged without being queued again.
+	"""
 	r = frappe.request
 	if not r:
 		return
@@ -18,72 +43,161 @@ def webhooks():
 	if not authenticate_signature(r):
 		raise frappe.AuthenticationError
 
-	gocardless_events = json.loads(r.get_data()) or []
-	for event in gocardless_events["events"]:
-		set_status(event)
+	gocardless_events = json.loads(r.get_data()) or {}
+	events = gocardless_events.get("events") or []
+	if not events or all(is_processed(events)):
+		return 200
+
+	doc = frappe.get_doc(
+		{
+			"doctype": "Integration Request",
+			"integration_request_service": "GoCardless",
+			"request_description": "Webhook",
+			"is_remote_request": 1,
+			"status": "Queued",
+			"data": json.dumps(gocardless_events),
+		}
+	).insert(ignore_permissions=True)
+	frappe.db.commit()  # nosemgrep
+
+	frappe.enqueue(
+		method="payments.payment_gateways.doctype.gocardless_settings.process_webhook",
+		queue="short",
+		now=frappe.flags.in_test,
+		docname=doc.name,
+	)
 
 	return 200
 
 
-def set_status(event):
-	resource_type = event.get("resource_type", {})
+@instrumented("gocardless.process_webhook")
+def process_webhook(docname):
+	"""Apply the new events of a webhook batch, each mandate is updated once with its final state.
 
-	if resource_type == "mandates":
-		set_mandate_status(event)
+	Events are marked as processed once applied. Applying an event twice, if batches overlap,
+	sets the same state again.
+	"""
+	doc = frappe.get_doc("Integration Request", docname)
 
+	try:
+		events = json.loads(doc.data)["events"]
+		new_events = [
+			event for event, processed in zip(events, is_processed(events), strict=True) if not processed
+		]
+		set_mandate_statuses(new_events)
+		doc.db_set("status", "Completed", update_modified=False)
+		frappe.db.commit()  # nosemgrep
+		mark_processed(new_events)
+	except Exception:
+		frappe.db.rollback()
+		doc.db_set({"status": "Failed", "error": frappe.get_traceback()}, update_modified=False)
+		frappe.log_error("GoCardless: Failed to process webhook")
 
-def set_mandate_status(event):
-	mandates = []
-	if isinstance(event["links"], list):
-		for link in event["links"]:
-			mandates.append(link["mandate"])
-	else:
-		mandates.append(event["links"]["mandate"])
-
-	if (
-		event["action"] == "pending_customer_approval"
-		or event["action"] == "pending_submission"
-		or event["action"] == "submitted"
-		or event["action"] == "active"
-	):
-		disabled = 0
+
+def is_processed(events):
+	"""Whether each event was already applied, without marking them."""
+	cache = frappe.cache()
+	pipeline = cache.pipeline()
+	for event in events:
+		pipeline.exists(cache.make_key(get_event_key(event)))
+
+	return [bool(exists) for exists in pipeline.execute()]
+
+
+def mark_processed(events):
+	cache = frappe.cache()
+	pipeline = cache.pipeline()
+	for event in events:
+		pipeline.set(cache.make_key(get_event_key(event)), 1, ex=EVENT_TTL)
+
+	pipeline.execute()
+
+
+def get_event_key(event):
+	return f"gocardless_webhook_event:{event['id']}"
+
+
+def set_mandate_statuses(events):
+	statuses = {}
+	for event in sorted(events, key=lambda event: event.get("created_at") or ""):
+		if event.get("resource_type") != "mandates":
+			continue
+
+		mandate_status = MANDATE_STATUSES.get(event["action"])
+		disabled = 0 if (mandate_status or event["action"]) in ACTIVE_MANDATE_ACTIONS else 1
+		links = event["links"] if isinstance(event["links"], list) else [event["links"]]
+		for link in links:
+			statuses[link["mandate"]] = (disabled, mandate_status)
+
+	if not statuses:
+		return
+
+	timestamp = now()
+	mandate = frappe.qb.DocType("GoCardless Mandate")
+	disabled, status, status_checked_at = Case(), Case(), Case()
+	for name, (is_disabled, mandate_status) in statuses.items():
+		disabled = disabled.when(mandate.name == name, is_disabled)
+		if mandate_status:
+			status = status.when(mandate.name == name, mandate_status)
+			status_checked_at = status_checked_at.when(mandate.name == name, timestamp)
+
+	query = (
+		frappe.qb.update(mandate)
+		.set(mandate.disabled, disabled.else_(mandate.disabled))
+		.set(mandate.modified, timestamp)
+		.set(mandate.modified_by, frappe.session.user)
+		.where(mandate.name.isin(list(statuses)))
+	)
+	# the status of a mandate whose last action does not tell it is fetched again on the next charge
+	if any(mandate_status for _, mandate_status in statuses.values()):
+		query = query.set(mandate.status, status.else_(mandate.status)).set(
+			mandate.status_checked_at, status_checked_at.else_(None)
+		)
 	else:
-		disabled = 1
+		query = query.set(mandate.status_checked_at, None)
 
-	for mandate in mandates:
-		frappe.db.set_value("GoCardless Mandate", mandate, "disabled", disabled)
+	query.run()
 
 
 def authenticate_signature(r):
-	"""Returns True if the received signature matches the generated signature"""
+	"""Returns True if the received signature matches the generated signature.
+
+	When the request names the account it is for, only the secret of that account is tried,
+	otherwise the secrets of all accounts are. GoCardless does not send the account itself, so
+	the hint is either a `gateway` query param of the webhook url, set in the GoCardless dashboard
+	of each account to `/api/method/payments.payment_gateways.doctype.gocardless_settings.webhooks?gateway=<GoCardless Settings name>`,
+	or a `X-Payments-Gateway` header added by a proxy in front of the site.
+
+	The body is hashed from the buffer frappe keeps of it, not from `request.stream`: frappe
+	reads the whole body to build `form_dict` before the webhook is called, so the stream is
+	already consumed and `get_data` returns that same buffer without copying it.
+	"""
 	received_signature = frappe.get_request_header("Webhook-Signature")
 
 	if not received_signature:
 		return False
 
-	for key in get_webhook_keys():
-		computed_signature = hmac.new(key.encode("utf-8"), r.get_data(), hashlib.sha256).hexdigest()
-		if hmac.compare_digest(str(received_signature), computed_signature):
-			return True
+	webhook_keys = get_webhook_keys()
+	if gateway := r.args.get("gateway") or frappe.get_request_header("X-Payments-Gateway"):
+		keys = [webhook_keys[gateway]] if gateway in webhook_keys else []
+	else:
+		keys = list(webhook_keys.values())
 
-	return False
+	return is_valid_signature(received_signature, keys, r.get_data())
 
 
 def get_webhook_keys():
+	"""Webhook secret of each GoCardless account, by settings name."""
+
 	def _get_webhook_keys():
-		webhook_keys = [
-			d.webhooks_secret
-			for d in frappe.get_all(
-				"GoCardless Settings",
-				fields=["webhooks_secret"],
-			)
+		return {
+			d.name: d.webhooks_secret
+			for d in frappe.get_all("GoCardless Settings", fields=["name", "webhooks_secret"])
 			if d.webhooks_secret
-		]
-
-		return webhook_keys
+		}
 
-	return frappe.cache().get_value("gocardless_webhooks_secret", _get_webhook_keys)
+	return frappe.cache().get_value("gocardless_webhook_keys", _get_webhook_keys)
 
 
 def clear_cache():
-	frappe.cache().delete_value("gocardless_webhooks_secret")
+	frappe.cache().delete_value("gocardless_webhook_keys")
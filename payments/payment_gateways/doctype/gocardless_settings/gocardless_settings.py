@@ -2,18 +2,54 @@
 # For license information, please see license.txt
 
 
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 
 import frappe
-import gocardless_pro
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, flt, get_url
+from frappe.query_builder import Case
+from frappe.utils import add_to_date, call_hook_method, cint, flt, get_datetime, get_url, now_datetime
+
+from payments.utils import bulk_create_request_logs, get_gateway_details
+from payments.utils.client_cache import get_client
+from payments.utils.http_client import resolve_url
+from payments.utils.lazy_import import lazy_import
+from payments.utils.metrics import instrumented
+from payments.utils.settings_cache import clear_settings_cache, get_settings
+
+gocardless_pro = lazy_import("gocardless_pro")
+
+API_URLS = {"live": "https://api.gocardless.com", "sandbox": "https://api-sandbox.gocardless.com"}
+ACTIVE_MANDATE_STATUSES = ("pending_customer_approval", "pending_submission", "submitted", "active")
+# mandate statuses are kept up to date by webhooks, they are fetched again once older than this
+DEFAULT_MANDATE_STATUS_TTL = 60 * 60
+DEFAULT_BULK_WORKERS = 8
+PAYMENT_REQUEST_FIELDS = (
+	"name",
+	"reference_doctype",
+	"reference_name",
+	"grand_total",
+	"currency",
+	"subject",
+	"email_to",
+)
+# status of the Integration Request of a payment, by status of the payment
+PAYMENT_STATUSES = {
+	"pending_submission": "Authorized",
+	"pending_customer_approval": "Authorized",
+	"submitted": "Authorized",
+	"confirmed": "Completed",
+	"paid_out": "Completed",
+	"cancelled": "Cancelled",
+	"customer_approval_denied": "Cancelled",
+	"charged_back": "Cancelled",
+}
 
 
 class GoCardlessSettings(Document):
-	supported_currencies = ("EUR", "DKK", "GBP", "SEK", "AUD", "NZD", "CAD", "USD")
+	supported_currencies = frozenset(("EUR", "DKK", "GBP", "SEK", "AUD", "NZD", "CAD", "USD"))
 
 	def validate(self):
 		self.initialize_client()
@@ -21,18 +57,36 @@ class GoCardlessSettings(Document):
 	def initialize_client(self):
 		self.environment = self.get_environment()
 		try:
-			self.client = gocardless_pro.Client(access_token=self.access_token, environment=self.environment)
+			self.client = gocardless_pro.Client(
+				access_token=self.access_token,
+				environment=self.environment,
+				base_url=resolve_url(API_URLS[self.environment]),
+			)
 			return self.client
 		except Exception as e:
 			frappe.throw(e)
 
+	def get_client(self):
+		"""Return the client of this account, rebuilt when the access token or environment change."""
+		credentials = (self.access_token, self.get_environment())
+		self.client = get_client("gocardless", self.name, credentials, self.initialize_client)
+		return self.client
+
 	def on_update(self):
+		from payments.payment_gateways.doctype.gocardless_settings import (
+			clear_cache as clear_webhook_keys_cache,
+		)
 		from payments.utils import create_payment_gateway
 
 		create_payment_gateway(
 			"GoCardless-" + self.gateway_name, settings="GoCardless Settings", controller=self.gateway_name
 		)
 		call_hook_method("payment_gateway_enabled", gateway="GoCardless-" + self.gateway_name)
+		clear_settings_cache(self)
+		clear_webhook_keys_cache()
+
+	def on_trash(self):
+		clear_settings_cache(self)
 
 	def on_payment_request_submission(self, data):
 		if data.reference_doctype != "Fees":
@@ -62,25 +116,62 @@ class GoCardlessSettings(Document):
 			return True
 
 	def check_mandate_validity(self, data):
-		if frappe.db.exists("GoCardless Mandate", dict(customer=data.get("payer_name"), disabled=0)):
-			registered_mandate = frappe.db.get_value(
-				"GoCardless Mandate", dict(customer=data.get("payer_name"), disabled=0), "mandate"
-			)
-			self.initialize_client()
-			mandate = self.client.mandates.get(registered_mandate)
+		mandate = frappe.db.get_value(
+			"GoCardless Mandate",
+			dict(customer=data.get("payer_name"), disabled=0),
+			["mandate", "status", "status_checked_at"],
+			as_dict=1,
+		)
+		if not mandate:
+			return None
 
-			if (
-				mandate.status == "pending_customer_approval"
-				or mandate.status == "pending_submission"
-				or mandate.status == "submitted"
-				or mandate.status == "active"
-			):
-				return {"mandate": registered_mandate}
-			else:
-				return None
+		self.refresh_mandate_statuses([mandate])
+		if mandate.status in ACTIVE_MANDATE_STATUSES:
+			return {"mandate": mandate.mandate}
 		else:
 			return None
 
+	def refresh_mandate_statuses(self, mandates):
+		"""Fetch the status of the mandates last checked more than `gocardless_mandate_status_ttl` ago.
+
+		`mandates` are dicts with `mandate`, `status` and `status_checked_at`, updated in place.
+		"""
+		ttl = cint(frappe.conf.gocardless_mandate_status_ttl) or DEFAULT_MANDATE_STATUS_TTL
+		checked_after = add_to_date(None, seconds=-ttl)
+		stale = [
+			m
+			for m in mandates
+			if not m.status or not m.status_checked_at or get_datetime(m.status_checked_at) < checked_after
+		]
+		if not stale:
+			return
+
+		client = self.get_client()
+		statuses = map_concurrently(lambda m: client.mandates.get(m.mandate).status, stale)
+
+		table = frappe.qb.DocType("GoCardless Mandate")
+		status = Case()
+		fetched = []
+		for mandate, mandate_status in zip(stale, statuses, strict=True):
+			if isinstance(mandate_status, Exception):
+				# the last known status is kept, it is fetched again next time
+				frappe.log_error("GoCardless Mandate Status Error", message=repr(mandate_status))
+				continue
+
+			mandate.status = mandate_status
+			status = status.when(table.name == mandate.mandate, mandate_status)
+			fetched.append(mandate.mandate)
+
+		if not fetched:
+			return
+
+		(
+			frappe.qb.update(table)
+			.set(table.status, status.else_(table.status))
+			.set(table.status_checked_at, now_datetime())
+			.where(table.name.isin(fetched))
+		).run()
+
 	def get_environment(self):
 		if self.use_sandbox:
 			return "sandbox"
@@ -95,9 +186,11 @@ class GoCardlessSettings(Document):
 				).format(currency)
 			)
 
+	@instrumented("gocardless.get_payment_url")
 	def get_payment_url(self, **kwargs):
 		return get_url(f"gocardless_checkout?{urlencode(kwargs)}")
 
+	@instrumented("gocardless.create_payment_request")
 	def create_payment_request(self, data):
 		self.data = frappe._dict(data)
 
@@ -117,12 +210,152 @@ class GoCardlessSettings(Document):
 				"status": 401,
 			}
 
+	@instrumented("gocardless.create_payment_requests")
+	def create_payment_requests(self, payment_requests):
+		"""Charge the mandates of many Payment Requests at once, e.g. at the end of a billing run.
+
+		`payment_requests` are Payment Request documents or rows with the fields of
+		`PAYMENT_REQUEST_FIELDS`.
+
+		Customers and mandates are read with one query each, payments are created concurrently
+		and their Integration Requests are written in bulk.
+
+		A batch can be submitted again after a failure: Payment Requests already charged, e.g.
+		when they were submitted, are skipped. The others reuse the Integration Request named
+		after them, and the Payment Request name is the idempotency key of their payment.
+
+		Returns, by Payment Request name, whether the payer still has to pay through the
+		checkout, like `on_payment_request_submission` does: only those without an active
+		mandate do, whether or not their payment could be created.
+		"""
+		charged = get_charged_payment_requests([pr.name for pr in payment_requests])
+		needs_checkout = {pr.name: pr.name not in charged for pr in payment_requests}
+		charges = self.get_bulk_charges([pr for pr in payment_requests if pr.name not in charged])
+		if not charges:
+			return needs_checkout
+
+		for data in charges:
+			needs_checkout[data.reference_docname] = False
+
+		request_logs = [(data.reference_docname, data, None) for data in charges]
+		bulk_create_request_logs(request_logs, "GoCardless")
+		# payments are created with idempotency keys, their request logs must exist before
+		frappe.db.commit()  # nosemgrep
+
+		client = self.get_client()
+
+		def create_payment(data):
+			return client.payments.create(
+				params={
+					"amount": cint(data.amount * 100),
+					"currency": data.currency,
+					"links": {"mandate": data.mandate},
+					"metadata": {
+						"reference_doctype": data.reference_doctype,
+						"reference_document": data.reference_docname,
+					},
+				},
+				headers={"Idempotency-Key": data.reference_docname},
+			)
+
+		payments = map_concurrently(create_payment, charges)
+
+		table = frappe.qb.DocType("Integration Request")
+		status, output, error = Case(), Case(), Case()
+		created, authorized = [], []
+		for (name, data, _error), payment in zip(request_logs, payments, strict=True):
+			if isinstance(payment, Exception):
+				frappe.log_error("GoCardless Payment Error", message=repr(payment))
+				continue
+
+			created.append(name)
+			payment_status = PAYMENT_STATUSES.get(payment.status, "Failed")
+			status = status.when(table.name == name, payment_status)
+			if payment_status in ("Authorized", "Completed"):
+				output = output.when(table.name == name, payment.status)
+				authorized.append(data.reference_docname)
+			else:
+				error = error.when(table.name == name, payment.status)
+
+		if created:
+			(
+				frappe.qb.update(table)
+				.set(table.status, status.else_(table.status))
+				.set(table.output, output.else_(table.output))
+				.set(table.error, error.else_(table.error))
+				.where(table.name.isin(created))
+			).run()
+
+		for name in authorized:
+			try:
+				frappe.get_doc("Payment Request", name).run_method("on_payment_authorized", "Completed")
+			except Exception:
+				frappe.log_error("Gocardless redirect failed")
+
+		return needs_checkout
+
+	def get_bulk_charges(self, payment_requests):
+		"""Payment data of the Payment Requests whose customer has an active mandate."""
+		references = {}
+		for pr in payment_requests:
+			if pr.reference_doctype != "Fees":
+				references.setdefault(pr.reference_doctype, set()).add(pr.reference_name)
+
+		customers = {}
+		for doctype, names in references.items():
+			for d in frappe.get_all(
+				doctype,
+				filters={"name": ("in", list(names))},
+				fields=["name", "company", "customer_name"],
+			):
+				customers[(doctype, d.name)] = d
+
+		if not customers:
+			return []
+
+		mandates = frappe.get_all(
+			"GoCardless Mandate",
+			filters={
+				"customer": ("in", list({c.customer_name for c in customers.values()})),
+				"disabled": 0,
+			},
+			fields=["customer", "mandate", "status", "status_checked_at"],
+		)
+		self.refresh_mandate_statuses(mandates)
+		mandate_by_customer = {m.customer: m.mandate for m in mandates if m.status in ACTIVE_MANDATE_STATUSES}
+
+		precision = frappe.get_precision("Payment Request", "grand_total")
+		charges = []
+		for pr in payment_requests:
+			customer = customers.get((pr.reference_doctype, pr.reference_name))
+			if not customer or customer.customer_name not in mandate_by_customer:
+				continue
+
+			charges.append(
+				frappe._dict(
+					{
+						"amount": flt(pr.grand_total, precision),
+						"title": customer.company,
+						"description": pr.subject,
+						"reference_doctype": "Payment Request",
+						"reference_docname": pr.name,
+						"payer_email": pr.email_to or frappe.session.user,
+						"payer_name": customer.customer_name,
+						"order_id": pr.name,
+						"currency": pr.currency,
+						"mandate": mandate_by_customer[customer.customer_name],
+					}
+				)
+			)
+
+		return charges
+
 	def create_charge_on_gocardless(self):
 		redirect_to = self.data.get("redirect_to") or None
 		redirect_message = self.data.get("redirect_message") or None
 
 		reference_doc = frappe.get_doc(self.data.get("reference_doctype"), self.data.get("reference_docname"))
-		self.initialize_client()
+		self.get_client()
 
 		try:
 			payment = self.client.payments.create(
@@ -197,16 +430,109 @@ class GoCardlessSettings(Document):
 		return {"redirect_to": redirect_url, "status": status}
 
 
-def get_gateway_controller(doc):
-	payment_request = frappe.get_doc("Payment Request", doc)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", payment_request.payment_gateway, "gateway_controller"
+@frappe.whitelist()
+def submit_payment_requests(payment_requests):
+	"""Charge the mandates of submitted GoCardless Payment Requests from a background job.
+
+	For billing runs that create many Payment Requests at once, instead of charging each one
+	when it is submitted.
+	"""
+	frappe.has_permission("Payment Request", "submit", throw=True)
+
+	frappe.enqueue(
+		"payments.payment_gateways.doctype.gocardless_settings.gocardless_settings.create_payment_requests",
+		queue="long",
+		now=frappe.flags.in_test,
+		enqueue_after_commit=True,
+		payment_requests=frappe.parse_json(payment_requests),
+	)
+
+
+def create_payment_requests(payment_requests):
+	"""Charge the mandates of GoCardless Payment Requests, grouped by the account they are paid to.
+
+	Returns, by Payment Request name, whether the payer still has to pay through the checkout.
+	"""
+	rows = frappe.get_all(
+		"Payment Request",
+		filters={
+			"name": ("in", list(payment_requests)),
+			"docstatus": 1,
+			"status": ("not in", ("Paid", "Cancelled")),
+		},
+		fields=["payment_gateway", *PAYMENT_REQUEST_FIELDS],
+	)
+	controllers = dict(
+		frappe.get_all(
+			"Payment Gateway",
+			filters={
+				"name": ("in", list({row.payment_gateway for row in rows})),
+				"gateway_settings": "GoCardless Settings",
+			},
+			fields=["name", "gateway_controller"],
+			as_list=True,
+		)
 	)
-	return gateway_controller
+
+	by_controller = {}
+	for row in rows:
+		if row.payment_gateway in controllers:
+			by_controller.setdefault(controllers[row.payment_gateway], []).append(row)
+
+	needs_checkout = {}
+	for controller, requests in by_controller.items():
+		settings = get_settings("GoCardless Settings", controller)
+		needs_checkout.update(settings.create_payment_requests(requests))
+
+	return needs_checkout
+
+
+def get_charged_payment_requests(payment_requests):
+	"""Payment Requests with a GoCardless Integration Request that got past being queued.
+
+	Those still queued were interrupted before their payment was recorded, their payment is
+	created again with the same idempotency key.
+	"""
+	if not payment_requests:
+		return set()
+
+	return set(
+		frappe.get_all(
+			"Integration Request",
+			filters={
+				"integration_request_service": "GoCardless",
+				"reference_doctype": "Payment Request",
+				"reference_docname": ("in", payment_requests),
+				"status": ("!=", "Queued"),
+			},
+			pluck="reference_docname",
+		)
+	)
+
+
+def map_concurrently(func, items):
+	"""Call `func` on each item from a pool of threads, they must only make API calls.
+
+	The exception raised for an item is returned in place of its result, so that one failing
+	call does not discard the others.
+	"""
+
+	def call(item):
+		try:
+			return func(item)
+		except Exception as e:
+			return e
+
+	workers = min(len(items), cint(frappe.conf.gocardless_bulk_workers) or DEFAULT_BULK_WORKERS)
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(call, items))
+
+
+def get_gateway_controller(doc):
+	return get_gateway_details("GoCardless Settings", "Payment Request", doc).gateway_controller
 
 
 def gocardless_initialization(doc):
 	gateway_controller = get_gateway_controller(doc)
-	settings = frappe.get_doc("GoCardless Settings", gateway_controller)
-	client = settings.initialize_client()
-	return client
+	settings = get_settings("GoCardless Settings", gateway_controller)
+	return settings.get_client()
@@ -1,8 +1,238 @@
 # Copyright (c) 2018, Frappe Technologies and Contributors
 # See license.txt
 
+import hashlib
+import hmac
 import unittest
+from unittest.mock import Mock, patch
+
+import frappe
+from frappe.utils import get_datetime
+from werkzeug.test import EnvironBuilder
+
+from payments.payment_gateways.doctype import gocardless_settings
+from payments.payment_gateways.doctype.gocardless_settings import (
+	authenticate_signature,
+	set_mandate_statuses,
+)
+from payments.payment_gateways.doctype.gocardless_settings.gocardless_settings import GoCardlessSettings
 
 
 class TestGoCardlessSettings(unittest.TestCase):
-	pass
+	def setUp(self):
+		self.settings = frappe.get_doc(
+			{
+				"doctype": "GoCardless Settings",
+				"gateway_name": "_Test",
+				"access_token": "_Test",
+				"use_sandbox": 1,
+			}
+		)
+		self.client = Mock()
+		patcher = patch.object(GoCardlessSettings, "get_client", return_value=self.client)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		frappe.db.delete("GoCardless Mandate", {"mandate": ("like", "_TEST-MD%")})
+		frappe.db.delete("Integration Request", {"integration_request_service": "GoCardless"})
+
+	def test_mandate_status_errors_do_not_discard_the_batch(self):
+		mandates = [create_mandate(f"_TEST-MD{i}") for i in range(3)]
+
+		def get_mandate(mandate):
+			if mandate == "_TEST-MD1":
+				raise ConnectionError("GoCardless is unreachable")
+			return Mock(status="active")
+
+		self.client.mandates.get.side_effect = get_mandate
+		self.settings.refresh_mandate_statuses(mandates)
+
+		self.assertEqual([m.status for m in mandates], ["active", None, "active"])
+		statuses = dict(
+			frappe.get_all(
+				"GoCardless Mandate",
+				filters={"mandate": ("like", "_TEST-MD%")},
+				fields=["mandate", "status_checked_at"],
+				as_list=True,
+			)
+		)
+		self.assertTrue(statuses["_TEST-MD0"])
+		self.assertIsNone(statuses["_TEST-MD1"])
+		self.assertTrue(statuses["_TEST-MD2"])
+
+	def test_fresh_mandate_statuses_are_not_fetched(self):
+		mandates = [
+			create_mandate("_TEST-MD0", status="active", status_checked_at=frappe.utils.now_datetime())
+		]
+
+		self.settings.refresh_mandate_statuses(mandates)
+
+		self.client.mandates.get.assert_not_called()
+
+	def test_payment_requests_with_an_active_mandate_skip_the_checkout(self):
+		charges = [get_charge("_Test PR 1", "_TEST-MD1"), get_charge("_Test PR 2", "_TEST-MD2")]
+
+		def create_payment(params, headers):
+			if params["links"]["mandate"] == "_TEST-MD2":
+				return Mock(status="customer_approval_denied")
+			return Mock(status="pending_submission")
+
+		self.client.payments.create.side_effect = create_payment
+		payment_requests = [frappe._dict(name=name) for name in ("_Test PR 1", "_Test PR 2", "_Test PR 3")]
+		with patch.object(GoCardlessSettings, "get_bulk_charges", return_value=charges):
+			needs_checkout = self.settings.create_payment_requests(payment_requests)
+
+		# like on_payment_request_submission, only payers without an active mandate go to the checkout
+		self.assertEqual(needs_checkout, {"_Test PR 1": False, "_Test PR 2": False, "_Test PR 3": True})
+		self.assertEqual(
+			self.client.payments.create.call_args_list[0].kwargs["headers"], {"Idempotency-Key": "_Test PR 1"}
+		)
+		self.assertEqual(
+			get_integration_request_statuses(), {"_Test PR 1": "Authorized", "_Test PR 2": "Cancelled"}
+		)
+
+	def test_payment_errors_do_not_discard_the_batch(self):
+		charges = [get_charge("_Test PR 1", "_TEST-MD1"), get_charge("_Test PR 2", "_TEST-MD2")]
+
+		def create_payment(params, headers):
+			if params["links"]["mandate"] == "_TEST-MD1":
+				raise ConnectionError("GoCardless is unreachable")
+			return Mock(status="confirmed")
+
+		self.client.payments.create.side_effect = create_payment
+		payment_requests = [frappe._dict(name=charge.reference_docname) for charge in charges]
+		with patch.object(GoCardlessSettings, "get_bulk_charges", return_value=charges):
+			self.settings.create_payment_requests(payment_requests)
+
+		self.assertEqual(
+			get_integration_request_statuses(), {"_Test PR 1": "Queued", "_Test PR 2": "Completed"}
+		)
+
+	def test_batch_submitted_again_only_charges_the_remaining_requests(self):
+		charges = [get_charge("_Test PR 1", "_TEST-MD1"), get_charge("_Test PR 2", "_TEST-MD2")]
+		outcomes = {
+			"_TEST-MD1": [ConnectionError("GoCardless is unreachable"), Mock(status="confirmed")],
+			"_TEST-MD2": [Mock(status="confirmed")],
+		}
+
+		def create_payment(params, headers):
+			outcome = outcomes[params["links"]["mandate"]].pop(0)
+			if isinstance(outcome, Exception):
+				raise outcome
+			return outcome
+
+		def get_bulk_charges(payment_requests):
+			names = {pr.name for pr in payment_requests}
+			return [charge for charge in charges if charge.reference_docname in names]
+
+		self.client.payments.create.side_effect = create_payment
+		payment_requests = [frappe._dict(name=charge.reference_docname) for charge in charges]
+		with (
+			patch.object(GoCardlessSettings, "get_bulk_charges", side_effect=get_bulk_charges),
+			patch.object(frappe, "get_doc") as get_doc,
+		):
+			self.settings.create_payment_requests(payment_requests)
+			needs_checkout = self.settings.create_payment_requests(payment_requests)
+
+		self.assertEqual(needs_checkout, {"_Test PR 1": False, "_Test PR 2": False})
+		# the payment that failed is created again, the other one is not
+		self.assertEqual(self.client.payments.create.call_count, 3)
+		self.assertEqual(
+			sorted(call.args for call in get_doc.call_args_list),
+			[("Payment Request", "_Test PR 1"), ("Payment Request", "_Test PR 2")],
+		)
+		# the Integration Request of the payment that failed is reused
+		self.assertEqual(
+			get_integration_request_statuses(), {"_Test PR 1": "Completed", "_Test PR 2": "Completed"}
+		)
+		self.assertEqual(
+			frappe.db.count("Integration Request", {"integration_request_service": "GoCardless"}), 2
+		)
+
+	def test_mandate_events_keep_the_cached_status_fresh(self):
+		create_mandate("_TEST-MD0", status="pending_submission", status_checked_at="2026-01-01 00:00:00")
+		create_mandate("_TEST-MD1", status="active", status_checked_at="2026-01-01 00:00:00")
+		events = [
+			{"resource_type": "mandates", "action": "active", "links": {"mandate": "_TEST-MD0"}},
+			{"resource_type": "mandates", "action": "transferred", "links": {"mandate": "_TEST-MD1"}},
+		]
+
+		set_mandate_statuses(events)
+
+		mandates = {
+			m.mandate: m
+			for m in frappe.get_all(
+				"GoCardless Mandate",
+				filters={"mandate": ("like", "_TEST-MD%")},
+				fields=["mandate", "status", "status_checked_at", "disabled"],
+			)
+		}
+		self.assertEqual(mandates["_TEST-MD0"].status, "active")
+		self.assertEqual(mandates["_TEST-MD0"].disabled, 0)
+		self.assertGreater(mandates["_TEST-MD0"].status_checked_at, get_datetime("2026-01-01"))
+		# the status after a transfer is not known, it is fetched again on the next charge
+		self.assertIsNone(mandates["_TEST-MD1"].status_checked_at)
+
+	def test_webhook_signature_is_checked_against_the_hinted_account(self):
+		body = b'{"events": []}'
+		signature = hmac.new(b"_Test Secret 2", body, hashlib.sha256).hexdigest()
+
+		def is_authentic(query_string=None, headers=None):
+			frappe.local.request = EnvironBuilder(
+				method="POST",
+				data=body,
+				headers={"Webhook-Signature": signature, **(headers or {})},
+				query_string=query_string,
+			).get_request()
+			try:
+				return authenticate_signature(frappe.local.request)
+			finally:
+				frappe.local.request = None
+
+		webhook_keys = {"_Test 1": "_Test Secret 1", "_Test 2": "_Test Secret 2"}
+		with patch.object(gocardless_settings, "get_webhook_keys", return_value=webhook_keys):
+			self.assertTrue(is_authentic())
+			self.assertTrue(is_authentic(query_string={"gateway": "_Test 2"}))
+			self.assertTrue(is_authentic(headers={"X-Payments-Gateway": "_Test 2"}))
+			self.assertFalse(is_authentic(query_string={"gateway": "_Test 1"}))
+			self.assertFalse(is_authentic(headers={"X-Payments-Gateway": "_Test 1"}))
+
+
+def create_mandate(mandate, status=None, status_checked_at=None):
+	frappe.get_doc(
+		{
+			"doctype": "GoCardless Mandate",
+			"mandate": mandate,
+			"gocardless_customer": "_Test Customer",
+			"status": status,
+			"status_checked_at": status_checked_at,
+		}
+	).db_insert()
+	return frappe._dict(mandate=mandate, status=status, status_checked_at=status_checked_at)
+
+
+def get_charge(payment_request, mandate):
+	return frappe._dict(
+		amount=100,
+		title="_Test Company",
+		description="_Test",
+		reference_doctype="Payment Request",
+		reference_docname=payment_request,
+		payer_email="test@example.com",
+		payer_name="_Test Customer",
+		order_id=payment_request,
+		currency="EUR",
+		mandate=mandate,
+	)
+
+
+def get_integration_request_statuses():
+	return dict(
+		frappe.get_all(
+			"Integration Request",
+			filters={"integration_request_service": "GoCardless"},
+			fields=["reference_docname", "status"],
+			as_list=True,
+		)
+	)
@@ -1,9 +1,21 @@
 import base64
 import datetime
 
-import requests
+import frappe
+from frappe.utils import cint
 from requests.auth import HTTPBasicAuth
 
+from payments.utils.http_client import get_timeout, request, resolve_url
+
+# tokens are refreshed this many seconds before Safaricom expires them
+TOKEN_EXPIRY_MARGIN = 60
+DEFAULT_TOKEN_EXPIRY = 3599
+INVALID_TOKEN_ERROR_CODE = "404.001.03"
+
+
+class InvalidTokenError(Exception):
+	"""The access token was rejected by Mpesa and could not be refreshed by the caller."""
+
 
 class MpesaConnector:
 	def __init__(
@@ -14,28 +26,81 @@ class MpesaConnector:
 		sandbox_url="https://sandbox.safaricom.co.ke",
 		live_url="https://api.safaricom.co.ke",
 	):
-		"""Setup configuration for Mpesa connector and generate new access token."""
+		"""Setup configuration for Mpesa connector, the access token is fetched on first use.
+
+		The timeout and url are resolved from the site config here, as the connector is also
+		used from worker threads which have no site context.
+		"""
 		self.env = env
 		self.app_key = app_key
 		self.app_secret = app_secret
-		if env == "sandbox":
-			self.base_url = sandbox_url
-		else:
-			self.base_url = live_url
-		self.authenticate()
+		self.base_url = resolve_url(sandbox_url if env == "sandbox" else live_url)
+		self.timeout = get_timeout("mpesa")
+		self._authentication_token = None
+
+	@property
+	def authentication_token(self):
+		if not self._authentication_token:
+			self._authentication_token = get_access_token(self)
+		return self._authentication_token
+
+	@authentication_token.setter
+	def authentication_token(self, value):
+		self._authentication_token = value
 
 	def authenticate(self):
 		"""
-		This method is used to fetch the access token required by Mpesa.
+		Replace the current access token, which Mpesa has rejected, with a new one.
+
+		Returns:
+		        access_token (str): This token is to be used with the Bearer header for further API calls to Mpesa.
+		"""
+		self._authentication_token = get_access_token(self, invalid_token=self._authentication_token)
+		return self._authentication_token
+
+	def generate_access_token(self):
+		"""
+		This method is used to fetch a new access token from Mpesa.
 
 		Returns:
 		        access_token (str): This token is to be used with the Bearer header for further API calls to Mpesa.
+		        expires_in (int): Seconds after which the token expires.
 		"""
 		authenticate_uri = "/oauth/v1/generate?grant_type=client_credentials"
 		authenticate_url = f"{self.base_url}{authenticate_uri}"
-		r = requests.get(authenticate_url, auth=HTTPBasicAuth(self.app_key, self.app_secret))
-		self.authentication_token = r.json()["access_token"]
-		return r.json()["access_token"]
+		r = request(
+			"mpesa",
+			"GET",
+			authenticate_url,
+			timeout=self.timeout,
+			auth=HTTPBasicAuth(self.app_key, self.app_secret),
+		)
+		response = r.json()
+		return response["access_token"], cint(response.get("expires_in")) or DEFAULT_TOKEN_EXPIRY
+
+	def post(self, uri, payload, refresh_token=True):
+		"""Post to the Mpesa API, retrying once with a new access token if the current one is rejected.
+
+		Refreshing the token goes through the cache, threads without a site context pass
+		`refresh_token=False` and get an `InvalidTokenError` instead.
+		"""
+		response = self._post(uri, payload)
+		if is_invalid_token_response(response):
+			if not refresh_token:
+				raise InvalidTokenError
+			self.authenticate()
+			response = self._post(uri, payload)
+
+		return response.json()
+
+	def _post(self, uri, payload):
+		headers = {
+			"Authorization": f"Bearer {self.authentication_token}",
+			"Content-Type": "application/json",
+		}
+		return request(
+			"mpesa", "POST", f"{self.base_url}{uri}", timeout=self.timeout, headers=headers, json=payload
+		)
 
 	def get_balance(
 		self,
@@ -76,13 +141,7 @@ class MpesaConnector:
 			"QueueTimeOutURL": queue_timeout_url,
 			"ResultURL": result_url,
 		}
-		headers = {
-			"Authorization": f"Bearer {self.authentication_token}",
-			"Content-Type": "application/json",
-		}
-		saf_url = "{}{}".format(self.base_url, "/mpesa/accountbalance/v1/query")
-		r = requests.post(saf_url, headers=headers, json=payload)
-		return r.json()
+		return self.post("/mpesa/accountbalance/v1/query", payload)
 
 	def stk_push(
 		self,
@@ -93,6 +152,7 @@ class MpesaConnector:
 		reference_code=None,
 		phone_number=None,
 		description=None,
+		refresh_token=True,
 	):
 		"""
 		This method uses Mpesa's Express API to initiate online payment on behalf of a customer.
@@ -135,11 +195,39 @@ class MpesaConnector:
 			"TransactionDesc": description,
 			"TransactionType": "CustomerPayBillOnline" if self.env == "sandbox" else "CustomerBuyGoodsOnline",
 		}
-		headers = {
-			"Authorization": f"Bearer {self.authentication_token}",
-			"Content-Type": "application/json",
-		}
+		return self.post("/mpesa/stkpush/v1/processrequest", payload, refresh_token=refresh_token)
+
+
+def get_access_token(connector, invalid_token=None):
+	"""
+	Return an access token for the connector's consumer key, shared by all workers through redis.
+
+	Only one caller refreshes an expired (or `invalid_token`) token at a time, the others wait
+	for it and use the token it fetched.
+	"""
+	cache = frappe.cache()
+	key = f"mpesa_access_token:{connector.env}:{connector.app_key}"
+
+	token = cache.get_value(key, expires=True)
+	if token and token != invalid_token:
+		return token
+
+	with cache.lock(cache.make_key(f"{key}:lock"), timeout=30, blocking_timeout=30):
+		token = cache.get_value(key, expires=True)
+		if token and token != invalid_token:
+			return token
+
+		token, expires_in = connector.generate_access_token()
+		cache.set_value(key, token, expires_in_sec=max(expires_in - TOKEN_EXPIRY_MARGIN, 1))
+
+	return token
+
+
+def is_invalid_token_response(response):
+	if response.status_code == 401:
+		return True
 
-		saf_url = "{}{}".format(self.base_url, "/mpesa/stkpush/v1/processrequest")
-		r = requests.post(saf_url, headers=headers, json=payload)
-		return r.json()
+	try:
+		return response.json().get("errorCode") == INVALID_TOKEN_ERROR_CODE
+	except ValueError:
+		return False
@@ -0,0 +1,113 @@
+"""
+Running totals of the Mpesa payments made against a reference document.
+
+A payment request larger than the transaction limit is paid in several chunks, each with
+its own callback. Instead of re-reading every completed chunk on each callback, the total
+paid and the receipts are kept in redis and updated atomically by a lua script, keyed on the
+checkout request id so a chunk is never counted twice.
+
+If the aggregate is not in redis (first chunk, or evicted) it is seeded from the
+completed Integration Requests of the reference document.
+"""
+
+import frappe
+from frappe.utils import cint, flt
+
+DEFAULT_TTL = 24 * 60 * 60
+
+# KEYS: set of counted checkout ids, total paid, list of receipts
+# ARGV: ttl, "1" if seed payments are passed, followed by (checkout id, amount, receipt)
+# triples. The last triple is the payment being recorded, the others are only used to seed
+# an aggregate that does not exist yet. Without seeds, nothing is recorded and nil is
+# returned when the aggregate does not exist, the caller then passes the seeds.
+RECORD_PAYMENT = """
+local exists = redis.call("EXISTS", KEYS[1]) == 1
+if ARGV[2] ~= "1" and not exists then
+	return false
+end
+
+local last = #ARGV - 2
+for i = 3, last, 3 do
+	if not exists or i == last then
+		if redis.call("SADD", KEYS[1], ARGV[i]) == 1 then
+			redis.call("INCRBYFLOAT", KEYS[2], ARGV[i + 1])
+			redis.call("RPUSH", KEYS[3], ARGV[i + 2])
+		end
+	end
+end
+
+for _, key in ipairs(KEYS) do
+	redis.call("EXPIRE", key, ARGV[1])
+end
+
+return {redis.call("GET", KEYS[2]), redis.call("LRANGE", KEYS[3], 0, -1)}
+"""
+
+# KEYS: same as above, ARGV: checkout id, amount, receipt
+DISCARD_PAYMENT = """
+if redis.call("SREM", KEYS[1], ARGV[1]) == 1 then
+	redis.call("INCRBYFLOAT", KEYS[2], -tonumber(ARGV[2]))
+	redis.call("LREM", KEYS[3], 1, ARGV[3])
+end
+"""
+
+
+def record_payment(reference_doctype, reference_docname, checkout_id, amount, receipt):
+	"""Add a completed chunk to the aggregate, returns the total paid and all the receipts so far."""
+	script = frappe.cache().register_script(RECORD_PAYMENT)
+	keys = get_keys(reference_doctype, reference_docname)
+	ttl = cint(frappe.conf.mpesa_payment_aggregate_ttl) or DEFAULT_TTL
+	payment = (checkout_id, flt(amount), receipt)
+
+	result = script(keys=keys, args=[ttl, 0, *payment])
+	if result is None:
+		seeds = []
+		for completed in get_completed_payments(reference_doctype, reference_docname, checkout_id):
+			seeds.extend(completed)
+		result = script(keys=keys, args=[ttl, 1, *seeds, *payment])
+
+	total_paid, receipts = result
+
+	return flt(total_paid), [frappe.safe_decode(receipt) for receipt in receipts]
+
+
+def discard_payment(reference_doctype, reference_docname, checkout_id, amount, receipt):
+	"""Take back a chunk whose processing failed after it was recorded."""
+	keys = get_keys(reference_doctype, reference_docname)
+	frappe.cache().register_script(DISCARD_PAYMENT)(keys=keys, args=[checkout_id, flt(amount), receipt])
+
+
+def get_keys(reference_doctype, reference_docname):
+	cache = frappe.cache()
+	prefix = f"mpesa_payments:{reference_doctype}:{reference_docname}"
+	return [cache.make_key(f"{prefix}:{key}") for key in ("checkout_ids", "total", "receipts")]
+
+
+def get_completed_payments(reference_doctype, reference_docname, checkout_id):
+	"""Return (checkout id, amount, receipt) of the other completed requests of the reference document."""
+	from payments.payment_gateways.doctype.mpesa_settings.mpesa_settings import fetch_param_value
+
+	completed_requests = frappe.get_all(
+		"Integration Request",
+		filters={
+			"name": ["!=", checkout_id],
+			"reference_doctype": reference_doctype,
+			"reference_docname": reference_docname,
+			"status": "Completed",
+		},
+		fields=["name", "output"],
+		order_by="creation asc",
+	)
+
+	payments = []
+	for request in completed_requests:
+		item_response = frappe.parse_json(request.output)["CallbackMetadata"]["Item"]
+		payments.append(
+			(
+				request.name,
+				flt(fetch_param_value(item_response, "Amount", "Name")),
+				fetch_param_value(item_response, "MpesaReceiptNumber", "Name"),
+			)
+		)
+
+	return payments
@@ -2,23 +2,35 @@
 # For license information, please see license.txt
 
 
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from json import dumps, loads
 
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, fmt_money, get_request_site_address
+from frappe.utils import call_hook_method, cint, fmt_money, get_request_site_address
 
-from payments.payment_gateways.doctype.mpesa_settings.mpesa_connector import MpesaConnector
+from payments.payment_gateways.doctype.mpesa_settings.mpesa_connector import (
+	InvalidTokenError,
+	MpesaConnector,
+)
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_custom_fields import (
 	create_custom_pos_fields,
 )
-from payments.utils import erpnext_app_import_guard
+from payments.payment_gateways.doctype.mpesa_settings.mpesa_payment_aggregate import (
+	discard_payment,
+	get_completed_payments,
+	record_payment,
+)
+from payments.utils import bulk_create_request_logs, erpnext_app_import_guard
+from payments.utils.metrics import instrumented
+from payments.utils.settings_cache import clear_settings_cache, get_password, get_settings
 
 
 class MpesaSettings(Document):
-	supported_currencies = ("KES",)
+	supported_currencies = frozenset(("KES",))
 
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
@@ -46,23 +58,66 @@ class MpesaSettings(Document):
 		# required to fetch the bank account details from the payment gateway account
 		frappe.db.commit()  # nosemgrep
 		create_mode_of_payment("Mpesa-" + self.payment_gateway_name, payment_type="Phone")
+		clear_settings_cache(self)
+
+	def on_trash(self):
+		clear_settings_cache(self)
 
+	@instrumented("mpesa.request_for_payment")
 	def request_for_payment(self, **kwargs):
+		"""Send an stk push for every chunk of the requested amount, all at once.
+
+		Returns the responses received for each chunk, in the order of the chunks.
+		"""
 		args = frappe._dict(kwargs)
 		request_amounts = self.split_request_amount_according_to_transaction_limit(args)
 
-		for _i, amount in enumerate(request_amounts):
-			args.request_amount = amount
-			if frappe.flags.in_test:
-				from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
-					get_payment_request_response_payload,
-				)
+		if frappe.flags.in_test:
+			from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
+				get_payment_request_response_payload,
+			)
 
-				response = frappe._dict(get_payment_request_response_payload(amount))
-			else:
-				response = frappe._dict(generate_stk_push(**args))
+			responses = [
+				frappe._dict(get_payment_request_response_payload(amount)) for amount in request_amounts
+			]
+		else:
+			responses = self.dispatch_stk_pushes(args, request_amounts)
+
+		return self.handle_api_responses("CheckoutRequestID", args, request_amounts, responses)
+
+	def dispatch_stk_pushes(self, args, request_amounts):
+		"""Make the stk push API calls concurrently, settings and credentials are resolved only once."""
+		try:
+			connector, push_args = get_stk_push_connector(self)
+			# fetch the access token before fanning out, workers have no access to the cache
+			connector.authentication_token
+			push_args.update(phone_number=sanitize_mobile_number(args.sender), description="POS Payment")
+		except Exception:
+			frappe.log_error("Mpesa Express Transaction Error")
+			frappe.throw(
+				_("Issue detected with Mpesa configuration, check the error logs for more details"),
+				title=_("Mpesa Express Error"),
+			)
+
+		def stk_push(amount):
+			try:
+				return frappe._dict(connector.stk_push(amount=amount, refresh_token=False, **push_args))
+			except Exception as e:
+				return e
 
-			self.handle_api_response("CheckoutRequestID", args, response)
+		workers = min(len(request_amounts), cint(frappe.conf.mpesa_stk_push_workers) or 8)
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			responses = list(executor.map(stk_push, request_amounts))
+
+			# the token expired while pushing, it is refreshed here as workers cannot use the cache
+			expired = [i for i, response in enumerate(responses) if isinstance(response, InvalidTokenError)]
+			if expired:
+				connector.authenticate()
+				retried = executor.map(stk_push, [request_amounts[i] for i in expired])
+				for i, response in zip(expired, retried, strict=True):
+					responses[i] = response
+
+		return responses
 
 	def split_request_amount_according_to_transaction_limit(self, args):
 		request_amount = args.request_amount
@@ -118,39 +173,63 @@ class MpesaSettings(Document):
 		if error:
 			frappe.throw(_(response.errorMessage), title=_("Transaction Error"))
 
+	def handle_api_responses(self, global_id, args, request_amounts, responses):
+		"""Record the responses of all the chunks of a payment request with a single insert."""
+		request_logs, errors, exceptions = [], [], []
+
+		for amount, response in zip(request_amounts, responses, strict=True):
+			if isinstance(response, Exception):
+				exceptions.append(response)
+				continue
+
+			request_dict = frappe._dict(args, request_amount=amount)
+			if response.requestId:
+				request_logs.append((response.requestId, request_dict, response))
+				errors.append(response)
+			else:
+				request_logs.append((getattr(response, global_id), request_dict, None))
+
+		if not (exceptions or errors):
+			bulk_create_request_logs(request_logs, "Mpesa")
+		elif request_logs:
+			# the caller's transaction is rolled back by the error raised below, the chunks that
+			# were pushed are recorded by a job of their own so that their callbacks find them
+			frappe.enqueue(
+				"payments.utils.bulk_create_request_logs",
+				queue="short",
+				now=frappe.flags.in_test,
+				request_logs=request_logs,
+				service_name="Mpesa",
+			)
+
+		if exceptions:
+			for exception in exceptions:
+				frappe.log_error(
+					"Mpesa Express Transaction Error", message="".join(traceback.format_exception(exception))
+				)
+			frappe.throw(
+				_("Issue detected with Mpesa configuration, check the error logs for more details"),
+				title=_("Mpesa Express Error"),
+			)
+
+		if errors:
+			frappe.throw(_(errors[0].errorMessage), title=_("Transaction Error"))
+
+		return responses
+
 
 def generate_stk_push(**kwargs):
 	"""Generate stk push by making a API call to the stk push API."""
 	args = frappe._dict(kwargs)
 	try:
-		callback_url = (
-			get_request_site_address(True)
-			+ "/api/method/payments.payment_gateways.doctype.mpesa_settings.mpesa_settings.verify_transaction"
-		)
-
-		mpesa_settings = frappe.get_doc("Mpesa Settings", args.payment_gateway[6:])
-		env = "production" if not mpesa_settings.sandbox else "sandbox"
-		# for sandbox, business shortcode is same as till number
-		business_shortcode = (
-			mpesa_settings.business_shortcode if env == "production" else mpesa_settings.till_number
-		)
-
-		connector = MpesaConnector(
-			env=env,
-			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
-		)
-
-		mobile_number = sanitize_mobile_number(args.sender)
+		mpesa_settings = get_settings("Mpesa Settings", args.payment_gateway[6:])
+		connector, push_args = get_stk_push_connector(mpesa_settings)
 
 		response = connector.stk_push(
-			business_shortcode=business_shortcode,
 			amount=args.request_amount,
-			passcode=mpesa_settings.get_password("online_passkey"),
-			callback_url=callback_url,
-			reference_code=mpesa_settings.till_number,
-			phone_number=mobile_number,
+			phone_number=sanitize_mobile_number(args.sender),
 			description="POS Payment",
+			**push_args,
 		)
 
 		return response
@@ -163,27 +242,88 @@ def generate_stk_push(**kwargs):
 		)
 
 
+def get_stk_push_connector(mpesa_settings):
+	"""Return the connector and the stk push arguments that are the same for every push."""
+	callback_url = (
+		get_request_site_address(True)
+		+ "/api/method/payments.payment_gateways.doctype.mpesa_settings.mpesa_settings.verify_transaction"
+	)
+
+	env = "production" if not mpesa_settings.sandbox else "sandbox"
+	# for sandbox, business shortcode is same as till number
+	business_shortcode = (
+		mpesa_settings.business_shortcode if env == "production" else mpesa_settings.till_number
+	)
+
+	connector = MpesaConnector(
+		env=env,
+		app_key=mpesa_settings.consumer_key,
+		app_secret=get_password(mpesa_settings, "consumer_secret", raise_exception=True),
+	)
+
+	push_args = dict(
+		business_shortcode=business_shortcode,
+		passcode=get_password(mpesa_settings, "online_passkey", raise_exception=True),
+		callback_url=callback_url,
+		reference_code=mpesa_settings.till_number,
+	)
+
+	return connector, push_args
+
+
 def sanitize_mobile_number(number):
 	"""Add country code and strip leading zeroes from the phone number."""
 	return "254" + str(number).lstrip("0")
 
 
 @frappe.whitelist(allow_guest=True)
+@instrumented("mpesa.verify_transaction")
 def verify_transaction(**kwargs):
-	"""Verify the transaction result received via callback from stk."""
+	"""Receive the transaction result callback from stk.
+
+	The callback is only validated and queued here so that Safaricom gets its response right
+	away, it is processed by `process_transaction_callback` in a background job. Callbacks
+	of unknown checkout requests are rejected, and those delivered more than once for the
+	same checkout request are queued only once.
+	"""
 	transaction_response = frappe._dict(kwargs["Body"]["stkCallback"])
 
 	checkout_id = getattr(transaction_response, "CheckoutRequestID", "")
-	if not isinstance(checkout_id, str):
+	if not checkout_id or not isinstance(checkout_id, str):
 		frappe.throw(_("Invalid Checkout Request ID"))
 
-	integration_request = frappe.get_doc("Integration Request", checkout_id)
+	if not frappe.db.exists("Integration Request", checkout_id):
+		frappe.throw(_("Invalid Checkout Request ID"))
+
+	frappe.enqueue(
+		method="payments.payment_gateways.doctype.mpesa_settings.mpesa_settings.process_transaction_callback",
+		queue="short",
+		job_id=f"mpesa::{checkout_id}",
+		deduplicate=True,
+		now=frappe.flags.in_test,
+		transaction_response=transaction_response,
+	)
+
+
+@instrumented("mpesa.process_transaction_callback")
+def process_transaction_callback(transaction_response):
+	"""Verify the transaction result received via callback from stk."""
+	transaction_response = frappe._dict(transaction_response)
+	checkout_id = transaction_response.CheckoutRequestID
+
+	# locked so that a callback delivered again once this job is done waits for it to finish
+	integration_request = frappe.get_doc("Integration Request", checkout_id, for_update=True)
+	if integration_request.status in ("Completed", "Failed"):
+		# callback was already processed
+		return
+
 	transaction_data = frappe._dict(loads(integration_request.data))
 	total_paid = 0  # for multiple integration request made against a pos invoice
 	success = False  # for reporting successfull callback to point of sale ui
 
 	if transaction_response["ResultCode"] == 0:
 		if integration_request.reference_doctype and integration_request.reference_docname:
+			payment = None
 			try:
 				item_response = transaction_response["CallbackMetadata"]["Item"]
 				amount = fetch_param_value(item_response, "Amount", "Name")
@@ -192,12 +332,15 @@ def verify_transaction(**kwargs):
 					integration_request.reference_doctype, integration_request.reference_docname
 				)
 
-				mpesa_receipts, completed_payments = get_completed_integration_requests_info(
-					integration_request.reference_doctype, integration_request.reference_docname, checkout_id
+				payment = (
+					integration_request.reference_doctype,
+					integration_request.reference_docname,
+					checkout_id,
+					amount,
+					mpesa_receipt,
 				)
-
-				total_paid = amount + sum(completed_payments)
-				mpesa_receipts = ", ".join([*mpesa_receipts, mpesa_receipt])
+				total_paid, mpesa_receipts = record_payment(*payment)
+				mpesa_receipts = ", ".join(mpesa_receipts)
 
 				if total_paid >= pr.grand_total:
 					pr.run_method("on_payment_authorized", "Completed")
@@ -206,6 +349,8 @@ def verify_transaction(**kwargs):
 				frappe.db.set_value("POS Invoice", pr.reference_name, "mpesa_receipt_number", mpesa_receipts)
 				integration_request.handle_success(transaction_response)
 			except Exception:
+				if payment:
+					discard_payment(*payment)
 				integration_request.handle_failure(transaction_response)
 				frappe.log_error("Mpesa: Failed to verify transaction")
 
@@ -228,39 +373,20 @@ def verify_transaction(**kwargs):
 
 
 def get_completed_integration_requests_info(reference_doctype, reference_docname, checkout_id):
-	output_of_other_completed_requests = frappe.get_all(
-		"Integration Request",
-		filters={
-			"name": ["!=", checkout_id],
-			"reference_doctype": reference_doctype,
-			"reference_docname": reference_docname,
-			"status": "Completed",
-		},
-		pluck="output",
-	)
-
-	mpesa_receipts, completed_payments = [], []
-
-	for out in output_of_other_completed_requests:
-		out = frappe._dict(loads(out))
-		item_response = out["CallbackMetadata"]["Item"]
-		completed_amount = fetch_param_value(item_response, "Amount", "Name")
-		completed_mpesa_receipt = fetch_param_value(item_response, "MpesaReceiptNumber", "Name")
-		completed_payments.append(completed_amount)
-		mpesa_receipts.append(completed_mpesa_receipt)
-
-	return mpesa_receipts, completed_payments
+	completed_payments = get_completed_payments(reference_doctype, reference_docname, checkout_id)
+	mpesa_receipts = [receipt for _, _, receipt in completed_payments]
+	return mpesa_receipts, [amount for _, amount, _ in completed_payments]
 
 
 def get_account_balance(request_payload):
 	"""Call account balance API to send the request to the Mpesa Servers."""
 	try:
-		mpesa_settings = frappe.get_doc("Mpesa Settings", request_payload.get("reference_docname"))
+		mpesa_settings = get_settings("Mpesa Settings", request_payload.get("reference_docname"))
 		env = "production" if not mpesa_settings.sandbox else "sandbox"
 		connector = MpesaConnector(
 			env=env,
 			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
+			app_secret=get_password(mpesa_settings, "consumer_secret", raise_exception=True),
 		)
 
 		callback_url = (
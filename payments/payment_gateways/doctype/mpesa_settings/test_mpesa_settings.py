@@ -1,15 +1,19 @@
 # Copyright (c) 2020, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
+import threading
 import unittest
 from json import dumps
+from unittest.mock import Mock, patch
 
 import frappe
 from erpnext.accounts.doctype.payment_entry.test_payment_entry import create_customer
 from erpnext.accounts.doctype.pos_invoice.test_pos_invoice import create_pos_invoice
 from erpnext.accounts.doctype.pos_profile.test_pos_profile import make_pos_profile
 from erpnext.stock.doctype.item.test_item import make_item
+from frappe.integrations.utils import create_request_log
 
+from payments.payment_gateways.doctype.mpesa_settings import mpesa_connector, mpesa_payment_aggregate
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_settings import (
 	create_mode_of_payment,
 	process_balance_info,
@@ -290,6 +294,122 @@ class TestMpesaSettings(unittest.TestCase):
 		pos_invoice.delete()
 
 
+class TestMpesaPaymentAggregate(unittest.TestCase):
+	def setUp(self):
+		self.reference = ("Payment Request", frappe.generate_hash(length=10))
+
+	def tearDown(self):
+		frappe.cache().delete(*mpesa_payment_aggregate.get_keys(*self.reference))
+
+	def test_aggregate_is_seeded_once(self):
+		seeds = [("ws_CO_seed", 100.0, "SEEDRECEIPT")]
+		with patch.object(
+			mpesa_payment_aggregate, "get_completed_payments", return_value=seeds
+		) as get_completed_payments:
+			for i in range(3):
+				total, receipts = mpesa_payment_aggregate.record_payment(
+					*self.reference, f"ws_CO_{i}", 500, f"RECEIPT{i}"
+				)
+
+		get_completed_payments.assert_called_once()
+		self.assertEqual(total, 1600)
+		self.assertEqual(receipts, ["SEEDRECEIPT", "RECEIPT0", "RECEIPT1", "RECEIPT2"])
+
+	def test_chunk_is_counted_once(self):
+		with patch.object(mpesa_payment_aggregate, "get_completed_payments", return_value=[]):
+			mpesa_payment_aggregate.record_payment(*self.reference, "ws_CO_0", 500, "RECEIPT0")
+			total, receipts = mpesa_payment_aggregate.record_payment(
+				*self.reference, "ws_CO_0", 500, "RECEIPT0"
+			)
+
+		self.assertEqual(total, 500)
+		self.assertEqual(receipts, ["RECEIPT0"])
+
+
+class TestMpesaStkPushDispatch(unittest.TestCase):
+	def tearDown(self):
+		frappe.db.sql("delete from `tabMpesa Settings`")
+
+	def test_expired_token_is_refreshed_on_the_main_thread(self):
+		settings = create_mpesa_settings(payment_gateway_name="_Test")
+		tokens = iter(["expired", "fresh"])
+		token_threads = []
+
+		def get_access_token(connector, invalid_token=None):
+			token_threads.append(threading.current_thread())
+			return next(tokens)
+
+		def request(gateway, method, url, headers=None, json=None, **kwargs):
+			if headers["Authorization"] == "Bearer expired":
+				return Mock(status_code=401, **{"json.return_value": {}})
+			return Mock(status_code=200, **{"json.return_value": {"CheckoutRequestID": json["Amount"]}})
+
+		with (
+			patch.object(mpesa_connector, "get_access_token", get_access_token),
+			patch.object(mpesa_connector, "request", request),
+		):
+			responses = settings.dispatch_stk_pushes(frappe._dict(sender="0712345678"), [500, 500, 300])
+
+		self.assertEqual([response.CheckoutRequestID for response in responses], [500, 500, 300])
+		self.assertEqual(token_threads, [threading.main_thread()] * 2)
+
+	def test_site_config_applies_to_the_worker_threads(self):
+		settings = create_mpesa_settings(payment_gateway_name="_Test")
+		requests = []
+
+		def request(gateway, method, url, timeout=None, **kwargs):
+			requests.append((url, timeout))
+			return Mock(status_code=200, **{"json.return_value": {"CheckoutRequestID": "ws_CO_0"}})
+
+		conf = {
+			"mpesa_http_timeout": [1, 2],
+			"payments_http_host_overrides": {"sandbox.safaricom.co.ke": "http://127.0.0.1:8002"},
+		}
+		with (
+			patch.dict(frappe.local.conf, conf),
+			patch.object(mpesa_connector, "get_access_token", return_value="token"),
+			patch.object(mpesa_connector, "request", request),
+		):
+			settings.dispatch_stk_pushes(frappe._dict(sender="0712345678"), [500, 300])
+
+		self.assertEqual(requests, [("http://127.0.0.1:8002/mpesa/stkpush/v1/processrequest", (1, 2))] * 2)
+
+
+class TestMpesaTransactionCallback(unittest.TestCase):
+	def setUp(self):
+		self.integration_request = create_request_log(
+			{"payment_reference": "_Test POS Invoice"},
+			service_name="Mpesa",
+			name=frappe.generate_hash(length=20),
+		)
+
+	def tearDown(self):
+		frappe.db.sql("delete from `tabIntegration Request` where integration_request_service = 'Mpesa'")
+
+	def test_redelivered_callback_is_processed_once(self):
+		callback_response = get_payment_callback_payload(CheckoutRequestID=self.integration_request.name)
+		callback_response["Body"]["stkCallback"].update(
+			ResultCode=1032, ResultDesc="Request cancelled by user"
+		)
+
+		with patch.object(frappe, "publish_realtime") as publish_realtime:
+			verify_transaction(**callback_response)
+			verify_transaction(**callback_response)
+
+		self.assertEqual(publish_realtime.call_count, 1)
+		self.assertEqual(
+			frappe.db.get_value("Integration Request", self.integration_request.name, "status"), "Failed"
+		)
+
+	def test_callback_of_unknown_checkout_request_is_rejected(self):
+		callback_response = get_payment_callback_payload(CheckoutRequestID="ws_CO_000000000000000000")
+
+		with patch.object(frappe, "enqueue") as enqueue:
+			self.assertRaises(frappe.ValidationError, verify_transaction, **callback_response)
+
+		enqueue.assert_not_called()
+
+
 def create_mpesa_settings(payment_gateway_name="Express"):
 	if frappe.db.exists("Mpesa Settings", payment_gateway_name):
 		return frappe.get_doc("Mpesa Settings", payment_gateway_name)
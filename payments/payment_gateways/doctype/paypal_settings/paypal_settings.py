@@ -68,43 +68,51 @@ from zoneinfo import ZoneInfo
 
 import frappe
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_post_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, get_datetime, get_url
 from frappe.utils.data import get_system_timezone
 
 from payments.utils import create_payment_gateway
+from payments.utils.http_client import make_post_request
+from payments.utils.idempotency import idempotent
+from payments.utils.metrics import instrumented
+from payments.utils.settings_cache import clear_settings_cache, get_password, get_settings
 
 api_path = "/api/method/payments.payment_gateways.doctype.paypal_settings.paypal_settings"
+# recurring payment profiles found by PayPal are not verified again for this long
+DEFAULT_PROFILE_VERIFICATION_TTL = 24 * 60 * 60
 
 
 class PayPalSettings(Document):
-	supported_currencies = (
-		"AUD",
-		"BRL",
-		"CAD",
-		"CZK",
-		"DKK",
-		"EUR",
-		"HKD",
-		"HUF",
-		"ILS",
-		"JPY",
-		"MYR",
-		"MXN",
-		"TWD",
-		"NZD",
-		"NOK",
-		"PHP",
-		"PLN",
-		"GBP",
-		"RUB",
-		"SGD",
-		"SEK",
-		"CHF",
-		"THB",
-		"TRY",
-		"USD",
+	supported_currencies = frozenset(
+		(
+			"AUD",
+			"BRL",
+			"CAD",
+			"CZK",
+			"DKK",
+			"EUR",
+			"HKD",
+			"HUF",
+			"ILS",
+			"JPY",
+			"MYR",
+			"MXN",
+			"TWD",
+			"NZD",
+			"NOK",
+			"PHP",
+			"PLN",
+			"GBP",
+			"RUB",
+			"SGD",
+			"SEK",
+			"CHF",
+			"THB",
+			"TRY",
+			"USD",
+		)
 	)
 
 	def __setup__(self):
@@ -121,7 +129,10 @@ class PayPalSettings(Document):
 			self.validate_paypal_credentails()
 
 	def on_update(self):
-		pass
+		clear_settings_cache(self)
+
+	def on_trash(self):
+		clear_settings_cache(self)
 
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
@@ -134,7 +145,7 @@ class PayPalSettings(Document):
 	def get_paypal_params_and_url(self):
 		params = {
 			"USER": self.api_username,
-			"PWD": self.get_password(fieldname="api_password", raise_exception=False),
+			"PWD": get_password(self, "api_password"),
 			"SIGNATURE": self.signature,
 			"VERSION": "98",
 			"METHOD": "GetPalDetails",
@@ -162,7 +173,7 @@ class PayPalSettings(Document):
 		params = urlencode(params)
 
 		try:
-			res = make_post_request(url=url, data=params.encode("utf-8"))
+			res = make_post_request("paypal", url=url, data=params.encode("utf-8"))
 
 			if res["ACK"][0] == "Failure":
 				raise Exception
@@ -170,6 +181,7 @@ class PayPalSettings(Document):
 		except Exception:
 			frappe.throw(_("Invalid payment gateway credentials"))
 
+	@instrumented("paypal.get_payment_url")
 	def get_payment_url(self, **kwargs):
 		self.use_sandbox = cint(kwargs.get("use_sandbox", 0))
 
@@ -209,7 +221,7 @@ class PayPalSettings(Document):
 			self.configure_recurring_payments(params, kwargs)
 
 		params = urlencode(params)
-		response = make_post_request(url, data=params.encode("utf-8"))
+		response = make_post_request("paypal", url, data=params.encode("utf-8"))
 
 		if response.get("ACK")[0] != "Success":
 			frappe.throw(_("Looks like something is wrong with this site's Paypal configuration."))
@@ -234,7 +246,7 @@ class PayPalSettings(Document):
 
 
 def get_paypal_and_transaction_details(token):
-	doc = frappe.get_doc("PayPal Settings")
+	doc = get_settings("PayPal Settings", copy=True)
 	doc.setup_sandbox_env(token)
 	params, url = doc.get_paypal_params_and_url()
 
@@ -265,13 +277,13 @@ def setup_redirect(data, redirect_url, custom_redirect_to=None, redirect=True):
 @frappe.whitelist(allow_guest=True, xss_safe=True)
 def get_express_checkout_details(token):
 	try:
-		doc = frappe.get_doc("PayPal Settings")
+		doc = get_settings("PayPal Settings", copy=True)
 		doc.setup_sandbox_env(token)
 
 		params, url = doc.get_paypal_params_and_url()
 		params.update({"METHOD": "GetExpressCheckoutDetails", "TOKEN": token})
 
-		response = make_post_request(url, data=params)
+		response = make_post_request("paypal", url, data=params)
 
 		if response.get("ACK")[0] != "Success":
 			frappe.respond_as_web_page(
@@ -301,6 +313,8 @@ def get_express_checkout_details(token):
 
 
 @frappe.whitelist(allow_guest=True, xss_safe=True)
+@instrumented("paypal.confirm_payment")
+@idempotent("paypal.confirm_payment", "token")
 def confirm_payment(token):
 	try:
 		custom_redirect_to = None
@@ -317,7 +331,7 @@ def confirm_payment(token):
 			}
 		)
 
-		response = make_post_request(url, data=params)
+		response = make_post_request("paypal", url, data=params)
 
 		if response.get("ACK")[0] == "Success":
 			update_integration_request_status(
@@ -348,6 +362,7 @@ def confirm_payment(token):
 
 
 @frappe.whitelist(allow_guest=True, xss_safe=True)
+@instrumented("paypal.create_recurring_profile")
 def create_recurring_profile(token, payerid):
 	try:
 		custom_redirect_to = None
@@ -384,7 +399,7 @@ def create_recurring_profile(token, payerid):
 		# "PROFILESTARTDATE": datetime.utcfromtimestamp(get_timestamp(starts_at)).isoformat()
 		params.update({"PROFILESTARTDATE": starts_at.isoformat()})
 
-		response = make_post_request(url, data=params)
+		response = make_post_request("paypal", url, data=params)
 
 		if response.get("ACK")[0] == "Success":
 			update_integration_request_status(
@@ -441,7 +456,7 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 		}
 	)
 
-	response = make_post_request(url, data=args)
+	response = make_post_request("paypal", url, data=args)
 
 	# error code 11556 indicates profile is not in active state(or already cancelled)
 	# thus could not cancel the subscription.
@@ -452,11 +467,14 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 
 
 @frappe.whitelist(allow_guest=True)
+@instrumented("paypal.ipn_handler")
 def ipn_handler():
+	"""Store the notification and verify it in the background, see `handle_subscription_notification`."""
 	try:
 		data = frappe.local.form_dict
 
-		validate_ipn_request(data)
+		if not data.get("recurring_payment_id"):
+			return
 
 		data.update({"payment_gateway": "PayPal"})
 
@@ -479,8 +497,6 @@ def ipn_handler():
 			**{"doctype": "Integration Request", "docname": doc.name},
 		)
 
-	except frappe.InvalidStatusError:
-		pass
 	except Exception as e:
 		frappe.log(frappe.log_error(title=e))
 
@@ -492,22 +508,53 @@ def validate_ipn_request(data):
 	if not data.get("recurring_payment_id"):
 		_throw()
 
-	doc = frappe.get_doc("PayPal Settings")
+	if not is_valid_recurring_payment_profile(data.get("recurring_payment_id")):
+		_throw()
+
+
+def is_valid_recurring_payment_profile(profile_id):
+	"""Whether PayPal knows the recurring payment profile.
+
+	Profiles found are remembered for `paypal_profile_verification_ttl` seconds, so the
+	notifications that follow for the same profile are not verified again.
+	"""
+	cache = frappe.cache()
+	key = f"paypal_recurring_payment_profile:{profile_id}"
+	if cache.get_value(key, expires=True):
+		return True
+
+	doc = get_settings("PayPal Settings")
 	params, url = doc.get_paypal_params_and_url()
 
 	params.update(
 		{
 			"METHOD": "GetRecurringPaymentsProfileDetails",
-			"PROFILEID": data.get("recurring_payment_id"),
+			"PROFILEID": profile_id,
 		}
 	)
 
 	params = urlencode(params)
-	res = make_post_request(url=url, data=params.encode("utf-8"))
+	res = make_post_request("paypal", url=url, data=params.encode("utf-8"))
 
 	if res["ACK"][0] != "Success":
-		_throw()
+		return False
 
+	ttl = cint(frappe.conf.paypal_profile_verification_ttl) or DEFAULT_PROFILE_VERIFICATION_TTL
+	cache.set_value(key, 1, expires_in_sec=ttl)
+	return True
 
+
+@instrumented("paypal.handle_subscription_notification")
 def handle_subscription_notification(doctype, docname):
+	"""Verify a stored notification with PayPal, then hand it over to the apps that handle it."""
+	doc = frappe.get_doc(doctype, docname)
+
+	try:
+		validate_ipn_request(json.loads(doc.data))
+	except frappe.InvalidStatusError:
+		doc.db_set(
+			{"status": "Failed", "error": _("Invalid recurring payment profile")}, update_modified=False
+		)
+		return
+
 	call_hook_method("handle_subscription_notification", doctype=doctype, docname=docname)
@@ -5,7 +5,6 @@ import json
 from urllib.parse import urlencode
 
 import frappe
-import requests
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
@@ -17,19 +16,30 @@ from frappe.utils import (
 	get_request_site_address,
 	get_url,
 )
-from frappe.utils.password import get_decrypted_password
-from paytmchecksum import generateSignature, verifySignature
 
-from payments.utils import create_payment_gateway
+from payments.utils import create_payment_gateway, get_gateway_details
+from payments.utils.http_client import request
+from payments.utils.idempotency import idempotent
+from payments.utils.lazy_import import lazy_import
+from payments.utils.metrics import instrumented
+from payments.utils.settings_cache import clear_settings_cache, get_password, get_settings
+
+paytmchecksum = lazy_import("paytmchecksum")
 
 
 class PaytmSettings(Document):
-	supported_currencies = ("INR",)
+	supported_currencies = frozenset(("INR",))
 
 	def validate(self):
 		create_payment_gateway("Paytm")
 		call_hook_method("payment_gateway_enabled", gateway="Paytm")
 
+	def on_update(self):
+		clear_settings_cache(self)
+
+	def on_trash(self):
+		clear_settings_cache(self)
+
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
 			frappe.throw(
@@ -38,6 +48,7 @@ class PaytmSettings(Document):
 				).format(currency)
 			)
 
+	@instrumented("paytm.get_payment_url")
 	def get_payment_url(self, **kwargs):
 		"""Return payment url with several params"""
 		# create unique order id by making it equal to the integration request
@@ -50,10 +61,9 @@ class PaytmSettings(Document):
 def get_paytm_config():
 	"""Returns paytm config"""
 
-	paytm_config = frappe.db.get_singles_dict("Paytm Settings")
-	paytm_config.update(
-		dict(merchant_key=get_decrypted_password("Paytm Settings", "Paytm Settings", "merchant_key"))
-	)
+	settings = get_settings("Paytm Settings")
+	paytm_config = frappe._dict(settings.as_dict(no_default_fields=True))
+	paytm_config.update(dict(merchant_key=get_password(settings, "merchant_key", raise_exception=True)))
 
 	if cint(paytm_config.staging):
 		paytm_config.update(
@@ -97,7 +107,7 @@ def get_paytm_params(payment_details, order_id, paytm_config):
 		}
 	)
 
-	checksum = generateSignature(paytm_params, paytm_config.merchant_key)
+	checksum = paytmchecksum.generateSignature(paytm_params, paytm_config.merchant_key)
 
 	paytm_params.update({"CHECKSUMHASH": checksum})
 
@@ -105,6 +115,8 @@ def get_paytm_params(payment_details, order_id, paytm_config):
 
 
 @frappe.whitelist(allow_guest=True)
+@instrumented("paytm.verify_transaction")
+@idempotent("paytm.verify_transaction", "ORDERID", "CHECKSUMHASH")
 def verify_transaction(**paytm_params):
 	"""Verify checksum for received data in the callback and then verify the transaction"""
 	paytm_config = get_paytm_config()
@@ -115,7 +127,9 @@ def verify_transaction(**paytm_params):
 
 	if paytm_params and paytm_config and paytm_checksum:
 		# Verify checksum
-		is_valid_checksum = verifySignature(paytm_params, paytm_config.merchant_key, paytm_checksum)
+		is_valid_checksum = paytmchecksum.verifySignature(
+			paytm_params, paytm_config.merchant_key, paytm_checksum
+		)
 
 	if is_valid_checksum and paytm_params.get("RESPCODE") == "01":
 		verify_transaction_status(paytm_config, paytm_params["ORDERID"])
@@ -133,13 +147,15 @@ def verify_transaction_status(paytm_config, order_id):
 	"""Verify transaction completion after checksum has been verified"""
 	paytm_params = dict(MID=paytm_config.merchant_id, ORDERID=order_id)
 
-	checksum = generateSignature(paytm_params, paytm_config.merchant_key)
+	checksum = paytmchecksum.generateSignature(paytm_params, paytm_config.merchant_key)
 	paytm_params["CHECKSUMHASH"] = checksum
 
 	post_data = json.dumps(paytm_params)
 	url = paytm_config.transaction_status_url
 
-	response = requests.post(url, data=post_data, headers={"Content-type": "application/json"}).json()
+	response = request(
+		"paytm", "POST", url, data=post_data, headers={"Content-type": "application/json"}
+	).json()
 	finalize_request(order_id, response)
 
 
@@ -179,8 +195,4 @@ def finalize_request(order_id, transaction_response):
 
 
 def get_gateway_controller(doctype, docname):
-	reference_doc = frappe.get_doc(doctype, docname)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", reference_doc.payment_gateway, "gateway_controller"
-	)
-	return gateway_controller
+	return get_gateway_details("Paytm Settings", doctype, docname).gateway_controller
@@ -0,0 +1,18 @@
+// Copyright (c) 2026, Frappe Technologies and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Razorpay Pending Capture", {
+  refresh: function (frm) {
+    if (frm.doc.status === "Dead") {
+      frm.add_custom_button(__("Requeue"), function () {
+        frm.call({
+          doc: frm.doc,
+          method: "requeue",
+          callback: function (r) {
+            frm.reload_doc();
+          },
+        });
+      });
+    }
+  },
+});
@@ -0,0 +1,56 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder.functions import Count, Max, Min
+from frappe.utils import cint, now_datetime
+
+
+class RazorpayPendingCapture(Document):
+	@frappe.whitelist()
+	def requeue(self):
+		"""Give a dead-lettered capture a fresh set of attempts."""
+		if self.status != "Dead":
+			return
+
+		self.db_set(
+			{"status": "Pending", "attempts": 0, "last_error": None, "next_attempt_at": now_datetime()}
+		)
+		frappe.db.set_value("Integration Request", self.integration_request, "status", "Authorized")
+
+
+def add_pending_capture(integration_request, data):
+	"""Queue an authorized payment so that the next `capture_payment` tick captures it."""
+	if frappe.db.exists("Razorpay Pending Capture", integration_request):
+		return
+
+	frappe.get_doc(
+		{
+			"doctype": "Razorpay Pending Capture",
+			"integration_request": integration_request,
+			"razorpay_payment_id": data.get("razorpay_payment_id"),
+			"amount": data.get("amount"),
+			"use_sandbox": cint(data.get("notes", {}).get("use_sandbox")) or cint(data.get("use_sandbox")),
+			"next_attempt_at": now_datetime(),
+		}
+	).insert(ignore_permissions=True)
+
+
+@frappe.whitelist()
+def get_queue_status():
+	"""Size of the capture backlog per status, along with the retries it holds."""
+	frappe.only_for("System Manager")
+
+	queue = frappe.qb.DocType("Razorpay Pending Capture")
+	return (
+		frappe.qb.from_(queue)
+		.select(
+			queue.status,
+			Count("*").as_("count"),
+			Max(queue.attempts).as_("max_attempts"),
+			Min(queue.next_attempt_at).as_("next_attempt_at"),
+		)
+		.groupby(queue.status)
+		.run(as_dict=True)
+	)
@@ -0,0 +1,87 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import unittest
+
+import frappe
+from frappe.integrations.utils import create_request_log
+
+from payments.payment_gateways.doctype.razorpay_pending_capture.razorpay_pending_capture import (
+	add_pending_capture,
+	get_queue_status,
+)
+
+
+class TestRazorpayPendingCapture(unittest.TestCase):
+	def setUp(self):
+		frappe.db.delete("Razorpay Pending Capture")
+
+	def tearDown(self):
+		frappe.db.delete("Razorpay Pending Capture")
+		frappe.db.delete("Integration Request", {"integration_request_service": "Razorpay"})
+
+	def test_authorized_payment_is_queued_once(self):
+		integration_request = create_authorized_request()
+		data = {"razorpay_payment_id": "pay_test1", "amount": 50000, "notes": {"use_sandbox": 1}}
+
+		add_pending_capture(integration_request, data)
+		add_pending_capture(integration_request, data)
+
+		self.assertEqual(frappe.db.count("Razorpay Pending Capture"), 1)
+		capture = frappe.get_doc("Razorpay Pending Capture", integration_request)
+		self.assertEqual(capture.razorpay_payment_id, "pay_test1")
+		self.assertEqual(capture.status, "Pending")
+		self.assertEqual(capture.use_sandbox, 1)
+		self.assertTrue(capture.next_attempt_at)
+
+	def test_requeue_gives_dead_capture_fresh_attempts(self):
+		integration_request = create_authorized_request()
+		add_pending_capture(integration_request, {"razorpay_payment_id": "pay_test1", "amount": 50000})
+		capture = frappe.get_doc("Razorpay Pending Capture", integration_request)
+		capture.db_set({"status": "Dead", "attempts": 8, "last_error": "BAD_REQUEST_ERROR"})
+		frappe.db.set_value("Integration Request", integration_request, "status", "Failed")
+
+		capture.requeue()
+
+		capture.reload()
+		self.assertEqual(capture.status, "Pending")
+		self.assertEqual(capture.attempts, 0)
+		self.assertIsNone(capture.last_error)
+		self.assertEqual(
+			frappe.db.get_value("Integration Request", integration_request, "status"), "Authorized"
+		)
+
+	def test_requeue_leaves_pending_capture_alone(self):
+		integration_request = create_authorized_request()
+		add_pending_capture(integration_request, {"razorpay_payment_id": "pay_test1", "amount": 50000})
+		capture = frappe.get_doc("Razorpay Pending Capture", integration_request)
+		capture.db_set("attempts", 3)
+
+		capture.requeue()
+
+		capture.reload()
+		self.assertEqual(capture.attempts, 3)
+
+	def test_queue_status(self):
+		for i in range(3):
+			add_pending_capture(create_authorized_request(), {"razorpay_payment_id": f"pay_test{i}"})
+		frappe.db.set_value(
+			"Razorpay Pending Capture",
+			frappe.get_all("Razorpay Pending Capture", pluck="name", limit=1)[0],
+			{"status": "Dead", "attempts": 8},
+		)
+
+		status = {row.status: row for row in get_queue_status()}
+
+		self.assertEqual(status["Pending"].count, 2)
+		self.assertEqual(status["Pending"].max_attempts, 0)
+		self.assertEqual(status["Dead"].count, 1)
+		self.assertEqual(status["Dead"].max_attempts, 8)
+
+
+def create_authorized_request():
+	integration_request = create_request_log(
+		{}, service_name="Razorpay", name=frappe.generate_hash(length=10)
+	)
+	integration_request.db_set("status", "Authorized")
+	return integration_request.name
@@ -0,0 +1,257 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Concurrent capture of authorized Razorpay payments.
+
+Fetching and capturing a payment are plain HTTP calls, so they are fanned out over a
+bounded thread pool. Worker threads never touch `frappe.local` (db, cache, flags);
+their results are handed back to the calling thread which writes status changes in batches.
+
+Payments waiting to be captured are read from the indexed `Razorpay Pending Capture` queue,
+only the entries that are due are fetched, one batch at a time.
+
+A failed capture caused by a network error, a rate limit or a 5xx from Razorpay is retried
+with exponential backoff and jitter, only the queue entry is touched while retrying.
+After `razorpay_capture_max_attempts` attempts, or on any other error, the entry is
+dead-lettered and its Integration Request is marked as Failed.
+
+Tuning (site config):
+
+	razorpay_capture_workers: size of the worker pool (default 8)
+	razorpay_capture_batch_size: payments fetched and status changes written per commit (default 50)
+	razorpay_capture_rate_limit: requests per second allowed per Razorpay account (default 10)
+	razorpay_capture_max_attempts: attempts before a capture is dead-lettered (default 5)
+	razorpay_capture_retry_delay: backoff in seconds before the first retry (default 60)
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import frappe
+import requests
+from frappe.utils import add_to_date, cint, flt, now_datetime
+
+from payments.utils.http_client import get_timeout, request
+from payments.utils.settings_cache import get_settings
+
+RAZORPAY_API_URL = "https://api.razorpay.com/v1"
+
+DEFAULT_WORKERS = 8
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_RATE_LIMIT = 10
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60
+MAX_RETRY_DELAY = 60 * 60
+
+# a tick that takes longer than this is assumed to be dead and its lock is released
+LOCK_TIMEOUT = 10 * 60
+LOCK_KEY = "razorpay_capture_payment_lock"
+STATS_KEY = "razorpay_capture_payment_stats"
+
+
+class RateLimiter:
+	"""Token bucket shared by all the workers talking to the same Razorpay account."""
+
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = rate
+		self.updated_at = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+				self.updated_at = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				wait = (1 - self.tokens) / self.rate
+
+			time.sleep(wait)
+
+
+class RazorpayCaptureEngine:
+	def __init__(self, workers=None, batch_size=None, rate_limit=None):
+		self.workers = cint(workers or frappe.conf.razorpay_capture_workers) or DEFAULT_WORKERS
+		self.batch_size = cint(batch_size or frappe.conf.razorpay_capture_batch_size) or DEFAULT_BATCH_SIZE
+		self.rate_limit = flt(rate_limit or frappe.conf.razorpay_capture_rate_limit) or DEFAULT_RATE_LIMIT
+		self.max_attempts = cint(frappe.conf.razorpay_capture_max_attempts) or DEFAULT_MAX_ATTEMPTS
+		self.retry_delay = flt(frappe.conf.razorpay_capture_retry_delay) or DEFAULT_RETRY_DELAY
+
+		self.controller = get_settings("Razorpay Settings")
+		self.settings = {}
+		self.limiters = {}
+		self.timeout = get_timeout("razorpay")
+		self.executor = None
+
+		self.completed = []
+		self.retries = []
+		self.failed = []
+		self.stats = frappe._dict(processed=0, captured=0, retried=0, failed=0)
+
+	def run(self):
+		"""Capture all due payments, returns the stats of this tick or None if another tick is running."""
+		cache = frappe.cache()
+		lock_key = cache.make_key(LOCK_KEY)
+
+		if not cache.set(lock_key, 1, nx=True, ex=LOCK_TIMEOUT):
+			frappe.logger("payments").info("Razorpay capture skipped: previous tick is still running")
+			return
+
+		try:
+			start = time.monotonic()
+			with ThreadPoolExecutor(max_workers=self.workers) as self.executor:
+				for payments in self.get_due_payments():
+					self.capture_all(payments)
+
+			self.stats.duration = round(time.monotonic() - start, 3)
+			self.stats.throughput = (
+				round(self.stats.processed / self.stats.duration, 2) if self.stats.duration else 0
+			)
+			cache.set_value(STATS_KEY, self.stats)
+			frappe.logger("payments").info(f"Razorpay capture tick: {self.stats}")
+
+			return self.stats
+		finally:
+			cache.delete(lock_key)
+
+	def get_due_payments(self):
+		"""Yield the due entries of the pending capture queue in keyset-paginated chunks."""
+		now = now_datetime()
+		last_name = ""
+
+		while True:
+			payments = frappe.get_all(
+				"Razorpay Pending Capture",
+				filters={"status": "Pending", "next_attempt_at": ("<=", now), "name": (">", last_name)},
+				fields=["name", "razorpay_payment_id", "amount", "use_sandbox", "attempts"],
+				order_by="name asc",
+				limit=self.batch_size,
+			)
+			if not payments:
+				return
+
+			for payment in payments:
+				settings = self.get_settings(payment.use_sandbox)
+				payment.auth = (settings.api_key, settings.api_secret)
+
+			yield payments
+
+			if len(payments) < self.batch_size:
+				return
+
+			last_name = payments[-1].name
+
+	def get_settings(self, use_sandbox):
+		"""Credentials are resolved once per tick for the live and sandbox accounts."""
+		use_sandbox = cint(use_sandbox)
+		if use_sandbox not in self.settings:
+			self.settings[use_sandbox] = self.controller.get_settings({"use_sandbox": use_sandbox})
+
+		return self.settings[use_sandbox]
+
+	def capture_all(self, payments):
+		for payment in payments:
+			api_key = payment.auth[0]
+			if api_key not in self.limiters:
+				self.limiters[api_key] = RateLimiter(self.rate_limit)
+
+		futures = {self.executor.submit(self.capture, payment): payment for payment in payments}
+
+		for future in as_completed(futures):
+			payment = futures[future]
+			self.stats.processed += 1
+
+			try:
+				resp = future.result()
+			except Exception as e:
+				payment.attempts += 1
+				if is_transient(e) and payment.attempts < self.max_attempts:
+					self.retries.append((payment, repr(e)))
+				else:
+					self.failed.append((payment, frappe.get_traceback()))
+			else:
+				if resp.get("status") == "captured":
+					self.completed.append(payment.name)
+
+		self.flush()
+
+	def capture(self, payment):
+		"""Runs in a worker thread, must not use the database or any other `frappe.local` state."""
+		url = f"{RAZORPAY_API_URL}/payments/{payment.razorpay_payment_id}"
+
+		resp = self.make_request("GET", url, payment)
+		if resp.get("status") == "authorized":
+			resp = self.make_request("POST", f"{url}/capture", payment, data={"amount": payment.amount})
+
+		return resp
+
+	def make_request(self, method, url, payment, data=None):
+		self.limiters[payment.auth[0]].acquire()
+
+		response = request("razorpay", method, url, auth=payment.auth, data=data, timeout=self.timeout)
+		response.raise_for_status()
+		return response.json()
+
+	def get_backoff(self, attempts):
+		"""Exponential backoff with jitter, so that retries of a burst of failures are spread out."""
+		delay = min(self.retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+		return delay / 2 + random.uniform(0, delay / 2)
+
+	def flush(self):
+		if self.completed:
+			frappe.db.set_value(
+				"Integration Request", {"name": ("in", self.completed)}, "status", "Completed"
+			)
+			frappe.db.delete("Razorpay Pending Capture", {"name": ("in", self.completed)})
+			self.stats.captured += len(self.completed)
+
+		for payment, error in self.retries:
+			frappe.db.set_value(
+				"Razorpay Pending Capture",
+				payment.name,
+				{
+					"attempts": payment.attempts,
+					"last_error": error,
+					"next_attempt_at": add_to_date(None, seconds=cint(self.get_backoff(payment.attempts))),
+				},
+				update_modified=False,
+			)
+
+		for payment, error in self.failed:
+			doc = frappe.get_doc("Integration Request", payment.name)
+			doc.status = "Failed"
+			doc.error = error
+			doc.save()
+			frappe.log_error(doc.error, f"{doc.name} Failed")
+			frappe.db.set_value(
+				"Razorpay Pending Capture",
+				payment.name,
+				{"status": "Dead", "attempts": payment.attempts, "last_error": error},
+				update_modified=False,
+			)
+
+		self.stats.retried += len(self.retries)
+		self.stats.failed += len(self.failed)
+		self.completed, self.retries, self.failed = [], [], []
+
+		frappe.db.commit()  # nosemgrep
+
+
+def is_transient(exc):
+	"""Errors worth retrying: network failures, rate limits and server errors from Razorpay."""
+	if isinstance(exc, requests.ConnectionError | requests.Timeout):
+		return True
+
+	if isinstance(exc, requests.HTTPError) and exc.response is not None:
+		return exc.response.status_code == 429 or exc.response.status_code >= 500
+
+	return False
@@ -59,31 +59,39 @@ For razorpay payment status is Authorized
 
 """
 
-import hashlib
-import hmac
 import json
 from urllib.parse import urlencode
 
 import frappe
-import razorpay
 from frappe import _
-from frappe.integrations.utils import (
-	create_request_log,
-	make_get_request,
-	make_post_request,
-)
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, get_timestamp, get_url
 
+from payments.payment_gateways.doctype.razorpay_pending_capture.razorpay_pending_capture import (
+	add_pending_capture,
+)
+from payments.payment_gateways.doctype.razorpay_settings.razorpay_capture import RazorpayCaptureEngine
 from payments.utils import create_payment_gateway
+from payments.utils.http_client import make_get_request, make_post_request
+from payments.utils.idempotency import idempotent
+from payments.utils.lazy_import import lazy_import
+from payments.utils.metrics import instrumented
+from payments.utils.settings_cache import clear_settings_cache, get_password, get_settings
+from payments.utils.signature import is_valid_signature
+
+razorpay = lazy_import("razorpay")
+
+# subscription statuses fetched from Razorpay are reused for this long
+DEFAULT_SUBSCRIPTION_STATUS_TTL = 60
 
 
 class RazorpaySettings(Document):
-	supported_currencies = ("INR",)
+	supported_currencies = frozenset(("INR",))
 
 	def init_client(self):
 		if self.api_key:
-			secret = self.get_password(fieldname="api_secret", raise_exception=False)
+			secret = get_password(self, "api_secret")
 			self.client = razorpay.Client(auth=(self.api_key, secret))
 
 	def validate(self):
@@ -92,10 +100,17 @@ class RazorpaySettings(Document):
 		if not self.flags.ignore_mandatory:
 			self.validate_razorpay_credentails()
 
+	def on_update(self):
+		clear_settings_cache(self)
+
+	def on_trash(self):
+		clear_settings_cache(self)
+
 	def validate_razorpay_credentails(self):
 		if self.api_key and self.api_secret:
 			try:
 				make_get_request(
+					"razorpay",
 					url="https://api.razorpay.com/v1/payments",
 					auth=(
 						self.api_key,
@@ -134,6 +149,7 @@ class RazorpaySettings(Document):
 
 			for addon in kwargs.get("addons"):
 				resp = make_post_request(
+					"razorpay",
 					url,
 					auth=(settings.api_key, settings.api_secret),
 					data=json.dumps(addon),
@@ -168,6 +184,7 @@ class RazorpaySettings(Document):
 
 		try:
 			resp = make_post_request(
+				"razorpay",
 				"https://api.razorpay.com/v1/subscriptions",
 				auth=(settings.api_key, settings.api_secret),
 				data=json.dumps(subscription_details),
@@ -193,6 +210,7 @@ class RazorpaySettings(Document):
 
 		return kwargs
 
+	@instrumented("razorpay.get_payment_url")
 	def get_payment_url(self, **kwargs):
 		integration_request = create_request_log(kwargs, service_name="Razorpay")
 		return get_url(f"./razorpay_checkout?token={integration_request.name}")
@@ -216,6 +234,7 @@ class RazorpaySettings(Document):
 		if self.api_key and self.api_secret:
 			try:
 				order = make_post_request(
+					"razorpay",
 					"https://api.razorpay.com/v1/orders",
 					auth=(
 						self.api_key,
@@ -229,6 +248,7 @@ class RazorpaySettings(Document):
 				frappe.log(frappe.get_traceback())
 				frappe.throw(_("Could not create razorpay order"))
 
+	@instrumented("razorpay.create_request")
 	def create_request(self, data):
 		self.data = frappe._dict(data)
 
@@ -249,6 +269,7 @@ class RazorpaySettings(Document):
 				"status": 401,
 			}
 
+	@instrumented("razorpay.authorize_payment")
 	def authorize_payment(self):
 		"""
 		An authorization is performed when user's payment details are successfully authenticated by the bank.
@@ -260,6 +281,7 @@ class RazorpaySettings(Document):
 
 		try:
 			resp = make_get_request(
+				"razorpay",
 				f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
 				auth=(settings.api_key, settings.api_secret),
 			)
@@ -267,6 +289,7 @@ class RazorpaySettings(Document):
 			if resp.get("status") == "authorized":
 				self.integration_request.update_status(data, "Authorized")
 				self.flags.status_changed_to = "Authorized"
+				add_pending_capture(self.integration_request.name, data)
 
 			elif resp.get("status") == "captured":
 				self.integration_request.update_status(data, "Completed")
@@ -323,7 +346,7 @@ class RazorpaySettings(Document):
 		settings = frappe._dict(
 			{
 				"api_key": self.api_key,
-				"api_secret": self.get_password(fieldname="api_secret", raise_exception=False),
+				"api_secret": get_password(self, "api_secret"),
 			}
 		)
 
@@ -342,6 +365,7 @@ class RazorpaySettings(Document):
 
 		try:
 			make_post_request(
+				"razorpay",
 				f"https://api.razorpay.com/v1/subscriptions/{subscription_id}/cancel",
 				auth=(settings.api_key, settings.api_secret),
 			)
@@ -349,13 +373,7 @@ class RazorpaySettings(Document):
 			frappe.log_error(frappe.get_traceback())
 
 	def verify_signature(self, body, signature, key):
-		key = bytes(key, "utf-8")
-		body = bytes(body, "utf-8")
-
-		dig = hmac.new(key=key, msg=body, digestmod=hashlib.sha256)
-
-		generated_signature = dig.hexdigest()
-		result = hmac.compare_digest(generated_signature, signature)
+		result = is_valid_signature(signature, [key], bytes(body, "utf-8"))
 
 		if not result:
 			frappe.throw(_("Razorpay Signature Verification Failed"), exc=frappe.PermissionError)
@@ -370,6 +388,7 @@ class RazorpaySettings(Document):
 		self.save()
 
 
+@instrumented("razorpay.capture_payment")
 def capture_payment(is_sandbox=False, sanbox_response=None):
 	"""
 	Verifies the purchase as complete by the merchant.
@@ -377,50 +396,19 @@ def capture_payment(is_sandbox=False, sanbox_response=None):
 	where T is the day on which payment is captured.
 
 	Note: Attempting to capture a payment whose status is not authorized will produce an error.
+	Authorized payments are fetched and captured concurrently, see `RazorpayCaptureEngine`.
 	"""
-	controller = frappe.get_doc("Razorpay Settings")
-
-	for doc in frappe.get_all(
-		"Integration Request",
-		filters={"status": "Authorized", "integration_request_service": "Razorpay"},
-		fields=["name", "data"],
-	):
-		try:
-			if is_sandbox:
-				resp = sanbox_response
-			else:
-				data = json.loads(doc.data)
-				settings = controller.get_settings(data)
+	engine = RazorpayCaptureEngine()
 
-				resp = make_get_request(
-					"https://api.razorpay.com/v1/payments/{}".format(data.get("razorpay_payment_id")),
-					auth=(settings.api_key, settings.api_secret),
-					data={"amount": data.get("amount")},
-				)
+	if is_sandbox:
+		engine.capture = lambda payment: sanbox_response
 
-				if resp.get("status") == "authorized":
-					resp = make_post_request(
-						"https://api.razorpay.com/v1/payments/{}/capture".format(
-							data.get("razorpay_payment_id")
-						),
-						auth=(settings.api_key, settings.api_secret),
-						data={"amount": data.get("amount")},
-					)
-
-			if resp.get("status") == "captured":
-				frappe.db.set_value("Integration Request", doc.name, "status", "Completed")
-
-		except Exception:
-			doc = frappe.get_doc("Integration Request", doc.name)
-			doc.status = "Failed"
-			doc.error = frappe.get_traceback()
-			doc.save()
-			frappe.log_error(doc.error, f"{doc.name} Failed")
+	return engine.run()
 
 
 @frappe.whitelist(allow_guest=True)
 def get_api_key():
-	controller = frappe.get_doc("Razorpay Settings")
+	controller = get_settings("Razorpay Settings")
 	return controller.api_key
 
 
@@ -437,6 +425,7 @@ def get_order(doctype, docname):
 
 
 @frappe.whitelist(allow_guest=True)
+@idempotent("razorpay.order_payment_success", "integration_request", "params")
 def order_payment_success(integration_request, params):
 	"""Called by razorpay.js on order payment success, the params
 	contains razorpay_payment_id, razorpay_order_id, razorpay_signature
@@ -454,14 +443,15 @@ def order_payment_success(integration_request, params):
 	integration.reload()
 
 	data = json.loads(integration.data)
-	controller = frappe.get_doc("Razorpay Settings")
+	controller = get_settings("Razorpay Settings", copy=True)
 
 	# Update payment and integration data for payment controller object
 	controller.integration_request = integration
 	controller.data = frappe._dict(data)
 
-	# Authorize payment
-	controller.authorize_payment()
+	# Authorize payment, the outcome is returned so that a replayed callback gets it back
+	# instead of authorizing the payment again
+	return controller.authorize_payment()
 
 
 @frappe.whitelist(allow_guest=True)
@@ -486,12 +476,15 @@ def convert_rupee_to_paisa(**kwargs):
 
 
 @frappe.whitelist(allow_guest=True)
+@instrumented("razorpay.subscription_callback")
 def razorpay_subscription_callback():
+	"""Store a signed subscription notification, its subscription is checked by the background job."""
+	if not is_valid_webhook_signature():
+		raise frappe.AuthenticationError
+
 	try:
 		data = frappe.local.form_dict
 
-		validate_payment_callback(data)
-
 		data.update({"payment_gateway": "Razorpay"})
 
 		doc = frappe.get_doc(
@@ -513,12 +506,25 @@ def razorpay_subscription_callback():
 			**{"doctype": "Integration Request", "docname": doc.name},
 		)
 
-	except frappe.InvalidStatusError:
-		pass
 	except Exception as e:
 		frappe.log(frappe.log_error(title=e))
 
 
+def is_valid_webhook_signature():
+	"""Whether the notification is signed with the webhook secret, if one is set.
+
+	Without a webhook secret, notifications are only trusted once the background job has
+	found their subscription active.
+	"""
+	webhook_secret = get_password(get_settings("Razorpay Settings"), "webhook_secret")
+	if not webhook_secret:
+		return True
+
+	return is_valid_signature(
+		frappe.get_request_header("X-Razorpay-Signature"), [webhook_secret], frappe.request.get_data()
+	)
+
+
 def validate_payment_callback(data):
 	def _throw():
 		frappe.throw(_("Invalid Subscription"), exc=frappe.InvalidStatusError)
@@ -528,18 +534,42 @@ def validate_payment_callback(data):
 	if not (subscription_id):
 		_throw()
 
-	controller = frappe.get_doc("Razorpay Settings")
+	if get_subscription_status(subscription_id, data) != "active":
+		_throw()
+
+
+def get_subscription_status(subscription_id, data):
+	"""Status of the subscription, fetched from Razorpay at most every `razorpay_subscription_status_ttl` seconds."""
+	cache = frappe.cache()
+	key = f"razorpay_subscription_status:{subscription_id}"
+	if status := cache.get_value(key, expires=True):
+		return status
+
+	controller = get_settings("Razorpay Settings")
 
 	settings = controller.get_settings(data)
 
 	resp = make_get_request(
+		"razorpay",
 		f"https://api.razorpay.com/v1/subscriptions/{subscription_id}",
 		auth=(settings.api_key, settings.api_secret),
 	)
 
-	if resp.get("status") != "active":
-		_throw()
+	status = resp.get("status")
+	ttl = cint(frappe.conf.razorpay_subscription_status_ttl) or DEFAULT_SUBSCRIPTION_STATUS_TTL
+	cache.set_value(key, status, expires_in_sec=ttl)
+	return status
 
 
+@instrumented("razorpay.handle_subscription_notification")
 def handle_subscription_notification(doctype, docname):
+	"""Check the subscription of a stored notification, then hand it over to the apps that handle it."""
+	doc = frappe.get_doc(doctype, docname)
+
+	try:
+		validate_payment_callback(json.loads(doc.data))
+	except frappe.InvalidStatusError:
+		doc.db_set({"status": "Failed", "error": _("Invalid Subscription")}, update_modified=False)
+		return
+
 	call_hook_method("handle_subscription_notification", doctype=doctype, docname=docname)
@@ -0,0 +1,157 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import unittest
+from unittest.mock import Mock, patch
+
+import frappe
+import requests
+from frappe.integrations.utils import create_request_log
+from frappe.utils import add_to_date, get_datetime, now_datetime
+
+from payments.payment_gateways.doctype.razorpay_pending_capture.razorpay_pending_capture import (
+	add_pending_capture,
+)
+from payments.payment_gateways.doctype.razorpay_settings import razorpay_capture
+from payments.payment_gateways.doctype.razorpay_settings.razorpay_capture import (
+	MAX_RETRY_DELAY,
+	RazorpayCaptureEngine,
+	is_transient,
+)
+
+
+class TestRazorpayCaptureEngine(unittest.TestCase):
+	def setUp(self):
+		frappe.db.delete("Razorpay Pending Capture")
+
+		controller = Mock()
+		controller.get_settings.return_value = frappe._dict(api_key="rzp_test", api_secret="secret")
+		patcher = patch.object(razorpay_capture, "get_settings", return_value=controller)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+		# status of each payment on Razorpay, or the status code its capture fails with
+		self.razorpay = {}
+		patcher = patch.object(razorpay_capture, "request", self.request)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		frappe.db.delete("Razorpay Pending Capture")
+		frappe.db.delete("Integration Request", {"integration_request_service": "Razorpay"})
+		frappe.db.commit()  # nosemgrep
+
+	def request(self, gateway, method, url, auth=None, data=None, timeout=None):
+		payment_id = url.split("/payments/")[1].split("/")[0]
+		outcome = self.razorpay[payment_id]
+		if isinstance(outcome, Exception):
+			raise outcome
+
+		response = Mock(status_code=outcome if isinstance(outcome, int) else 200)
+		if isinstance(outcome, int):
+			response.raise_for_status.side_effect = requests.HTTPError(response=response)
+		elif url.endswith("/capture"):
+			response.json.return_value = {"id": payment_id, "status": "captured"}
+		else:
+			response.json.return_value = {"id": payment_id, "status": outcome}
+		return response
+
+	def add_payment(self, outcome, due=True):
+		integration_request = create_request_log(
+			{}, service_name="Razorpay", name=frappe.generate_hash(length=10)
+		)
+		integration_request.db_set("status", "Authorized")
+		payment_id = f"pay_{integration_request.name}"
+		add_pending_capture(integration_request.name, {"razorpay_payment_id": payment_id, "amount": 50000})
+		if not due:
+			frappe.db.set_value(
+				"Razorpay Pending Capture",
+				integration_request.name,
+				"next_attempt_at",
+				add_to_date(None, hours=1),
+			)
+
+		self.razorpay[payment_id] = outcome
+		return integration_request.name
+
+	def test_due_payments_are_paginated_by_name(self):
+		names = sorted(self.add_payment("authorized") for _ in range(5))
+		self.add_payment("authorized", due=False)
+		engine = RazorpayCaptureEngine(batch_size=2)
+
+		with patch.object(frappe, "get_all", wraps=frappe.get_all) as get_all:
+			batches = [[payment.name for payment in payments] for payments in engine.get_due_payments()]
+
+		self.assertEqual(batches, [names[0:2], names[2:4], names[4:5]])
+		self.assertEqual(
+			[call.kwargs["filters"]["name"] for call in get_all.call_args_list],
+			[(">", ""), (">", names[1]), (">", names[3])],
+		)
+
+	def test_authorized_payment_is_captured(self):
+		name = self.add_payment("authorized")
+
+		stats = RazorpayCaptureEngine(rate_limit=100).run()
+
+		self.assertEqual(stats.captured, 1)
+		self.assertFalse(frappe.db.exists("Razorpay Pending Capture", name))
+		self.assertEqual(frappe.db.get_value("Integration Request", name, "status"), "Completed")
+
+	def test_transient_error_is_retried_with_backoff(self):
+		names = [
+			self.add_payment(503),
+			self.add_payment(429),
+			self.add_payment(requests.ConnectionError("connection reset")),
+		]
+
+		stats = RazorpayCaptureEngine(rate_limit=100).run()
+
+		self.assertEqual(stats.retried, 3)
+		for name in names:
+			capture = frappe.get_doc("Razorpay Pending Capture", name)
+			self.assertEqual(capture.status, "Pending")
+			self.assertEqual(capture.attempts, 1)
+			self.assertGreater(get_datetime(capture.next_attempt_at), now_datetime())
+			self.assertEqual(frappe.db.get_value("Integration Request", name, "status"), "Authorized")
+
+	def test_permanent_error_is_dead_lettered(self):
+		name = self.add_payment(400)
+
+		stats = RazorpayCaptureEngine(rate_limit=100).run()
+
+		self.assertEqual(stats.failed, 1)
+		self.assertEqual(frappe.db.get_value("Razorpay Pending Capture", name, "status"), "Dead")
+		self.assertEqual(frappe.db.get_value("Integration Request", name, "status"), "Failed")
+
+	def test_transient_error_is_dead_lettered_after_the_last_attempt(self):
+		name = self.add_payment(503)
+		engine = RazorpayCaptureEngine(rate_limit=100)
+		frappe.db.set_value("Razorpay Pending Capture", name, "attempts", engine.max_attempts - 1)
+
+		engine.run()
+
+		capture = frappe.get_doc("Razorpay Pending Capture", name)
+		self.assertEqual(capture.status, "Dead")
+		self.assertEqual(capture.attempts, engine.max_attempts)
+		self.assertEqual(frappe.db.get_value("Integration Request", name, "status"), "Failed")
+
+	def test_backoff_grows_exponentially_up_to_the_limit(self):
+		engine = RazorpayCaptureEngine()
+		engine.retry_delay = 60
+
+		for attempts, delay in ((1, 60), (2, 120), (3, 240), (20, MAX_RETRY_DELAY)):
+			backoff = engine.get_backoff(attempts)
+			self.assertGreaterEqual(backoff, delay / 2)
+			self.assertLessEqual(backoff, delay)
+
+	def test_transient_errors(self):
+		def http_error(status_code):
+			return requests.HTTPError(response=Mock(status_code=status_code))
+
+		self.assertTrue(is_transient(requests.ConnectionError()))
+		self.assertTrue(is_transient(requests.Timeout()))
+		self.assertTrue(is_transient(http_error(429)))
+		self.assertTrue(is_transient(http_error(502)))
+		self.assertFalse(is_transient(http_error(400)))
+		self.assertFalse(is_transient(http_error(401)))
+		self.assertFalse(is_transient(ValueError()))
@@ -0,0 +1,56 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import json
+import unittest
+from unittest.mock import patch
+
+import frappe
+from frappe.integrations.utils import create_request_log
+from frappe.model.document import Document
+
+from payments.payment_gateways.doctype.razorpay_settings import razorpay_settings
+from payments.payment_gateways.doctype.razorpay_settings.razorpay_settings import (
+	RazorpaySettings,
+	order_payment_success,
+)
+
+
+class TestRazorpaySettings(unittest.TestCase):
+	def setUp(self):
+		self.response = frappe.local.response
+		frappe.local.response = frappe._dict()
+		# set by the http client on the requests it makes, which are mocked here
+		frappe.flags.integration_request = frappe._dict(status_code=200)
+		self.todo = frappe.get_doc({"doctype": "ToDo", "description": "_Test Razorpay order"}).insert()
+		self.integration_request = create_request_log(
+			{"reference_doctype": "ToDo", "reference_docname": self.todo.name, "amount": 50000},
+			service_name="Razorpay",
+			name=frappe.generate_hash(length=10),
+		)
+
+	def tearDown(self):
+		frappe.local.response = self.response
+		frappe.flags.integration_request = None
+		self.todo.delete()
+		frappe.db.delete("Integration Request", {"integration_request_service": "Razorpay"})
+		frappe.cache().delete_keys("payments_idempotency:razorpay.order_payment_success")
+
+	def test_replayed_order_payment_success_authorizes_once(self):
+		params = json.dumps({"razorpay_payment_id": "pay_test1", "razorpay_order_id": "order_test1"})
+
+		with (
+			patch.object(RazorpaySettings, "get_settings", return_value=frappe._dict(api_key="_Test")),
+			patch.object(razorpay_settings, "make_get_request", return_value={"status": "captured"}),
+			patch.object(Document, "run_method") as run_method,
+		):
+			first = order_payment_success(self.integration_request.name, params)
+			replayed = order_payment_success(self.integration_request.name, params)
+
+		authorizations = [c for c in run_method.call_args_list if c.args[0] == "on_payment_authorized"]
+		self.assertEqual(len(authorizations), 1)
+		self.assertEqual(replayed, first)
+		self.assertTrue(first["redirect_to"].startswith("payment-success"))
+		self.assertEqual(
+			frappe.db.get_value("Integration Request", self.integration_request.name, "status"), "Completed"
+		)
@@ -6,11 +6,14 @@ from urllib.parse import urlencode
 
 import frappe
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_get_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, flt, get_url
 
-from payments.utils import create_payment_gateway
+from payments.utils import create_payment_gateway, get_gateway_details
+from payments.utils.http_client import make_get_request
+from payments.utils.metrics import instrumented
+from payments.utils.settings_cache import clear_settings_cache
 
 currency_wise_minimum_charge_amount = {
 	"JPY": 50,
@@ -32,121 +35,123 @@ currency_wise_minimum_charge_amount = {
 
 
 class StripeSettings(Document):
-	supported_currencies = (
-		"AED",
-		"ALL",
-		"ANG",
-		"ARS",
-		"AUD",
-		"AWG",
-		"BBD",
-		"BDT",
-		"BIF",
-		"BMD",
-		"BND",
-		"BOB",
-		"BRL",
-		"BSD",
-		"BWP",
-		"BZD",
-		"CAD",
-		"CHF",
-		"CLP",
-		"CNY",
-		"COP",
-		"CRC",
-		"CVE",
-		"CZK",
-		"DJF",
-		"DKK",
-		"DOP",
-		"DZD",
-		"EGP",
-		"ETB",
-		"EUR",
-		"FJD",
-		"FKP",
-		"GBP",
-		"GIP",
-		"GMD",
-		"GNF",
-		"GTQ",
-		"GYD",
-		"HKD",
-		"HNL",
-		"HRK",
-		"HTG",
-		"HUF",
-		"IDR",
-		"ILS",
-		"INR",
-		"ISK",
-		"JMD",
-		"JPY",
-		"KES",
-		"KHR",
-		"KMF",
-		"KRW",
-		"KYD",
-		"KZT",
-		"LAK",
-		"LBP",
-		"LKR",
-		"LRD",
-		"MAD",
-		"MDL",
-		"MNT",
-		"MOP",
-		"MRO",
-		"MUR",
-		"MVR",
-		"MWK",
-		"MXN",
-		"MYR",
-		"NAD",
-		"NGN",
-		"NIO",
-		"NOK",
-		"NPR",
-		"NZD",
-		"PAB",
-		"PEN",
-		"PGK",
-		"PHP",
-		"PKR",
-		"PLN",
-		"PYG",
-		"QAR",
-		"RUB",
-		"SAR",
-		"SBD",
-		"SCR",
-		"SEK",
-		"SGD",
-		"SHP",
-		"SLL",
-		"SOS",
-		"STD",
-		"SVC",
-		"SZL",
-		"THB",
-		"TOP",
-		"TTD",
-		"TWD",
-		"TZS",
-		"UAH",
-		"UGX",
-		"USD",
-		"UYU",
-		"UZS",
-		"VND",
-		"VUV",
-		"WST",
-		"XAF",
-		"XOF",
-		"XPF",
-		"YER",
-		"ZAR",
+	supported_currencies = frozenset(
+		(
+			"AED",
+			"ALL",
+			"ANG",
+			"ARS",
+			"AUD",
+			"AWG",
+			"BBD",
+			"BDT",
+			"BIF",
+			"BMD",
+			"BND",
+			"BOB",
+			"BRL",
+			"BSD",
+			"BWP",
+			"BZD",
+			"CAD",
+			"CHF",
+			"CLP",
+			"CNY",
+			"COP",
+			"CRC",
+			"CVE",
+			"CZK",
+			"DJF",
+			"DKK",
+			"DOP",
+			"DZD",
+			"EGP",
+			"ETB",
+			"EUR",
+			"FJD",
+			"FKP",
+			"GBP",
+			"GIP",
+			"GMD",
+			"GNF",
+			"GTQ",
+			"GYD",
+			"HKD",
+			"HNL",
+			"HRK",
+			"HTG",
+			"HUF",
+			"IDR",
+			"ILS",
+			"INR",
+			"ISK",
+			"JMD",
+			"JPY",
+			"KES",
+			"KHR",
+			"KMF",
+			"KRW",
+			"KYD",
+			"KZT",
+			"LAK",
+			"LBP",
+			"LKR",
+			"LRD",
+			"MAD",
+			"MDL",
+			"MNT",
+			"MOP",
+			"MRO",
+			"MUR",
+			"MVR",
+			"MWK",
+			"MXN",
+			"MYR",
+			"NAD",
+			"NGN",
+			"NIO",
+			"NOK",
+			"NPR",
+			"NZD",
+			"PAB",
+			"PEN",
+			"PGK",
+			"PHP",
+			"PKR",
+			"PLN",
+			"PYG",
+			"QAR",
+			"RUB",
+			"SAR",
+			"SBD",
+			"SCR",
+			"SEK",
+			"SGD",
+			"SHP",
+			"SLL",
+			"SOS",
+			"STD",
+			"SVC",
+			"SZL",
+			"THB",
+			"TOP",
+			"TTD",
+			"TWD",
+			"TZS",
+			"UAH",
+			"UGX",
+			"USD",
+			"UYU",
+			"UZS",
+			"VND",
+			"VUV",
+			"WST",
+			"XAF",
+			"XOF",
+			"XPF",
+			"YER",
+			"ZAR",
+		)
 	)
 
 	currency_wise_minimum_charge_amount = MappingProxyType(currency_wise_minimum_charge_amount)
@@ -158,9 +163,13 @@ class StripeSettings(Document):
 			controller=self.gateway_name,
 		)
 		call_hook_method("payment_gateway_enabled", gateway="Stripe-" + self.gateway_name)
+		clear_settings_cache(self)
 		if not self.flags.ignore_mandatory:
 			self.validate_stripe_credentails()
 
+	def on_trash(self):
+		clear_settings_cache(self)
+
 	def validate_stripe_credentails(self):
 		if self.publishable_key and self.secret_key:
 			header = {
@@ -169,7 +178,7 @@ class StripeSettings(Document):
 				)
 			}
 			try:
-				make_get_request(url="https://api.stripe.com/v1/charges", headers=header)
+				make_get_request("stripe", url="https://api.stripe.com/v1/charges", headers=header)
 			except Exception:
 				frappe.throw(_("Seems Publishable Key or Secret Key is wrong !!!"))
 
@@ -190,15 +199,13 @@ class StripeSettings(Document):
 					)
 				)
 
+	@instrumented("stripe.get_payment_url")
 	def get_payment_url(self, **kwargs):
 		return get_url(f"./stripe_checkout?{urlencode(kwargs)}")
 
+	@instrumented("stripe.create_request")
 	def create_request(self, data):
-		import stripe
-
 		self.data = frappe._dict(data)
-		stripe.api_key = self.get_password(fieldname="secret_key", raise_exception=False)
-		stripe.default_http_client = stripe.http_client.RequestsClient()
 
 		try:
 			self.integration_request = create_request_log(self.data, service_name="Stripe")
@@ -217,15 +224,17 @@ class StripeSettings(Document):
 			}
 
 	def create_charge_on_stripe(self):
-		import stripe
+		from payments.payment_gateways.stripe_integration import get_stripe_client
 
 		try:
-			charge = stripe.Charge.create(
-				amount=cint(flt(self.data.amount) * 100),
-				currency=self.data.currency,
-				source=self.data.stripe_token_id,
-				description=self.data.description,
-				receipt_email=self.data.payer_email,
+			charge = get_stripe_client(self).charges.create(
+				params={
+					"amount": cint(flt(self.data.amount) * 100),
+					"currency": self.data.currency,
+					"source": self.data.stripe_token_id,
+					"description": self.data.description,
+					"receipt_email": self.data.payer_email,
+				}
 			)
 
 			if charge.captured is True:
@@ -278,8 +287,4 @@ class StripeSettings(Document):
 
 
 def get_gateway_controller(doctype, docname, payment_gateway=None):
-	if not payment_gateway:
-		reference_doc = frappe.get_doc(doctype, docname)
-		payment_gateway = reference_doc.payment_gateway
-	gateway_controller = frappe.db.get_value("Payment Gateway", payment_gateway, "gateway_controller")
-	return gateway_controller
+	return get_gateway_details("Stripe Settings", doctype, docname, payment_gateway).gateway_controller
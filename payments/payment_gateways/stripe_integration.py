@@ -2,18 +2,40 @@
 # For license information, please see license.txt
 
 import frappe
-import stripe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 
+from payments.utils.client_cache import get_client
+from payments.utils.http_client import get_session, get_timeout
+from payments.utils.lazy_import import lazy_import
+from payments.utils.settings_cache import get_password, get_settings
+
+stripe = lazy_import("stripe")
+
+
+def get_stripe_client(stripe_settings):
+	"""Return the client of a Stripe account, replaced when the secret key changes.
+
+	Each client holds its own api key, so several accounts can be used concurrently, and sends
+	its requests through the pooled Stripe session.
+	"""
+	secret_key = get_password(stripe_settings, "secret_key")
+	return get_client("stripe", stripe_settings.name, secret_key, lambda: make_stripe_client(secret_key))
+
+
+def make_stripe_client(secret_key):
+	return stripe.StripeClient(
+		secret_key,
+		http_client=stripe.http_client.RequestsClient(
+			timeout=get_timeout("stripe"), session=get_session("stripe")
+		),
+	)
+
 
 def create_stripe_subscription(gateway_controller, data):
-	stripe_settings = frappe.get_doc("Stripe Settings", gateway_controller)
+	stripe_settings = get_settings("Stripe Settings", gateway_controller, copy=True)
 	stripe_settings.data = frappe._dict(data)
 
-	stripe.api_key = stripe_settings.get_password(fieldname="secret_key", raise_exception=False)
-	stripe.default_http_client = stripe.http_client.RequestsClient()
-
 	try:
 		stripe_settings.integration_request = create_request_log(stripe_settings.data, "Host", "Stripe")
 		stripe_settings.payment_plans = frappe.get_doc(
@@ -41,13 +63,16 @@ def create_subscription_on_stripe(stripe_settings):
 		items.append({"price": plan, "quantity": payment_plan.qty})
 
 	try:
-		customer = stripe.Customer.create(
-			source=stripe_settings.data.stripe_token_id,
-			description=stripe_settings.data.payer_name,
-			email=stripe_settings.data.payer_email,
+		client = get_stripe_client(stripe_settings)
+		customer = client.customers.create(
+			params={
+				"source": stripe_settings.data.stripe_token_id,
+				"description": stripe_settings.data.payer_name,
+				"email": stripe_settings.data.payer_email,
+			}
 		)
 
-		subscription = stripe.Subscription.create(customer=customer, items=items)
+		subscription = client.subscriptions.create(params={"customer": customer.id, "items": items})
 
 		if subscription.status == "active":
 			stripe_settings.integration_request.db_set("status", "Completed", update_modified=False)
@@ -3,6 +3,12 @@
 
 from frappe.model.document import Document
 
+from payments.utils.gateway_registry import clear_registry
+
 
 class PaymentGateway(Document):
-	pass
+	def on_update(self):
+		clear_registry()
+
+	def on_trash(self):
+		clear_registry()
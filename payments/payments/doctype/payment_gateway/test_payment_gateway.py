@@ -2,8 +2,59 @@
 # License: MIT. See LICENSE
 import unittest
 
+import frappe
+
+from payments.utils.gateway_registry import (
+	clear_registry,
+	get_gateway,
+	get_gateways_for_currency,
+	supports_currency,
+)
+
 # test_records = frappe.get_test_records('Payment Gateway')
 
 
 class TestPaymentGateway(unittest.TestCase):
-	pass
+	def setUp(self):
+		frappe.get_doc(
+			{
+				"doctype": "Braintree Settings",
+				"gateway_name": "_Test Configured",
+				"merchant_id": "_Test",
+				"public_key": "_Test",
+				"private_key": "*****",
+			}
+		).db_insert()
+		# a gateway whose settings document is missing, e.g. after a failed setup
+		for name in ("_Test Configured", "_Test Unconfigured"):
+			frappe.get_doc(
+				{
+					"doctype": "Payment Gateway",
+					"gateway": name,
+					"gateway_settings": "Braintree Settings",
+					"gateway_controller": name,
+				}
+			).db_insert()
+		clear_registry()
+
+	def tearDown(self):
+		frappe.db.delete("Payment Gateway", {"name": ("in", ("_Test Configured", "_Test Unconfigured"))})
+		frappe.db.delete("Braintree Settings", {"name": "_Test Configured"})
+		clear_registry()
+
+	def test_only_configured_gateways_are_indexed_by_currency(self):
+		self.assertTrue(get_gateway("_Test Configured").enabled)
+		self.assertFalse(get_gateway("_Test Unconfigured").enabled)
+
+		self.assertIn("_Test Configured", get_gateways_for_currency("USD"))
+		self.assertNotIn("_Test Unconfigured", get_gateways_for_currency("USD"))
+		self.assertTrue(supports_currency("_Test Configured", "USD"))
+		self.assertFalse(supports_currency("_Test Unconfigured", "USD"))
+
+	def test_deleted_settings_leave_the_registry(self):
+		self.assertTrue(get_gateway("_Test Configured").enabled)
+
+		frappe.delete_doc("Braintree Settings", "_Test Configured", force=True)
+
+		self.assertFalse(get_gateway("_Test Configured").enabled)
+		self.assertNotIn("_Test Configured", get_gateways_for_currency("USD"))
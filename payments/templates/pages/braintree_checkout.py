@@ -11,6 +11,8 @@ from payments.payment_gateways.doctype.braintree_settings.braintree_settings imp
 	get_client_token,
 	get_gateway_controller,
 )
+from payments.utils import get_gateway_details
+from payments.utils.idempotency import idempotent
 
 no_cache = 1
 
@@ -39,8 +41,9 @@ def get_context(context):
 
 		context["amount"] = flt(context["amount"])
 
-		gateway_controller = get_gateway_controller(context.reference_docname)
-		context["header_img"] = frappe.db.get_value("Braintree Settings", gateway_controller, "header_img")
+		context["header_img"] = get_gateway_details(
+			"Braintree Settings", "Payment Request", context.reference_docname, fields=("header_img",)
+		).header_img
 
 	else:
 		frappe.redirect_to_message(
@@ -52,6 +55,7 @@ def get_context(context):
 
 
 @frappe.whitelist(allow_guest=True)
+@idempotent("braintree.make_payment", "payload_nonce")
 def make_payment(payload_nonce, data, reference_doctype, reference_docname):
 	data = json.loads(data)
 
@@ -6,6 +6,8 @@ import frappe
 from frappe import _
 from frappe.utils import cint, flt
 
+from payments.utils.idempotency import idempotent
+from payments.utils.settings_cache import get_settings
 from payments.utils.utils import validate_integration_request
 
 no_cache = 1
@@ -56,7 +58,7 @@ def get_context(context):
 
 
 def get_api_key():
-	api_key = frappe.db.get_single_value("Razorpay Settings", "api_key")
+	api_key = get_settings("Razorpay Settings").api_key
 	if cint(frappe.form_dict.get("use_sandbox")):
 		api_key = frappe.conf.sandbox_api_key
 
@@ -64,6 +66,7 @@ def get_api_key():
 
 
 @frappe.whitelist(allow_guest=True)
+@idempotent("razorpay.make_payment", "razorpay_payment_id", "token")
 def make_payment(razorpay_payment_id, options, reference_doctype, reference_docname, token):
 	data = {}
 
@@ -79,6 +82,6 @@ def make_payment(razorpay_payment_id, options, reference_doctype, reference_docn
 		}
 	)
 
-	data = frappe.get_doc("Razorpay Settings").create_request(data)
+	data = get_settings("Razorpay Settings", copy=True).create_request(data)
 	frappe.db.commit()
 	return data
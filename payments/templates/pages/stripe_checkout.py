@@ -9,6 +9,7 @@ from frappe.utils import cint, fmt_money
 from payments.payment_gateways.doctype.stripe_settings.stripe_settings import (
 	get_gateway_controller,
 )
+from payments.utils import get_gateway_details
 
 no_cache = 1
 
@@ -32,11 +33,15 @@ def get_context(context):
 	if not (set(expected_keys) - set(list(frappe.form_dict))):
 		for key in expected_keys:
 			context[key] = frappe.form_dict[key]
-		gateway_controller = get_gateway_controller(
-			context.reference_doctype, context.reference_docname, context.payment_gateway
+		gateway = get_gateway_details(
+			"Stripe Settings",
+			context.reference_doctype,
+			context.reference_docname,
+			context.payment_gateway,
+			fields=("publishable_key", "header_img"),
 		)
-		context.publishable_key = get_api_key(context.reference_docname, gateway_controller)
-		context.image = get_header_image(context.reference_docname, gateway_controller)
+		context.publishable_key = get_api_key(context.reference_docname, gateway)
+		context.image = gateway.header_img
 
 		context["amount"] = fmt_money(amount=context["amount"], currency=context["currency"])
 
@@ -57,20 +62,14 @@ def get_context(context):
 		raise frappe.Redirect
 
 
-def get_api_key(doc, gateway_controller):
-	publishable_key = frappe.db.get_value("Stripe Settings", gateway_controller, "publishable_key")
+def get_api_key(doc, gateway):
+	publishable_key = gateway.publishable_key
 	if cint(frappe.form_dict.get("use_sandbox")):
 		publishable_key = frappe.conf.sandbox_publishable_key
 
 	return publishable_key
 
 
-def get_header_image(doc, gateway_controller):
-	header_image = frappe.db.get_value("Stripe Settings", gateway_controller, "header_img")
-
-	return header_image
-
-
 @frappe.whitelist(allow_guest=True)
 def make_payment(stripe_token_id, data, reference_doctype=None, reference_docname=None, payment_gateway=None):
 	data = json.loads(data)
@@ -0,0 +1,452 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Checkout benchmarks for the payment gateways, run against local stand-ins of their APIs.
+
+	bench --site test_site execute payments.tests.benchmark.run \\
+		--kwargs "{'gateways': ['razorpay'], 'concurrency': 16, 'iterations': 200, 'latency': 0.05}"
+
+Each iteration of a flow goes through the gateway's checkout steps (payment url, callback, ...)
+the way a request would, from `concurrency` threads with their own database connection.
+Steps that work on all the payments at once, like Razorpay's capture, run once at the end.
+Throughput, p50/p99 latency and queries per step are printed and returned.
+
+Only runs on sites with `allow_tests` enabled, as it creates Integration Requests and
+marks the reference document as paid. Gateways without settings on the site are skipped,
+their credentials are only ever sent to the stubs.
+
+The reference document defaults to a new ToDo. M-Pesa callbacks compare the amount paid
+with the `grand_total` of the reference, pass a Payment Request to benchmark their success path.
+GoCardless payments are only charged when the reference is a Payment Request whose customer
+has a GoCardless Mandate, each iteration then sends a webhook for the mandate and charges it.
+"""
+
+import hashlib
+import hmac
+import json
+import queue
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import frappe
+from frappe.utils import cint
+
+from payments.tests.stub_servers import StubServers, random_id
+from payments.utils.http_client import set_host_overrides
+from payments.utils.metrics import count_queries
+from payments.utils.settings_cache import get_settings
+
+
+class Flow:
+	gateway = None
+	settings_doctype = None
+	currency = "INR"
+
+	def __init__(self):
+		self.settings_name = self.get_settings_name()
+
+	def get_settings_name(self):
+		return frappe.db.get_value(self.settings_doctype, {}, "name")
+
+	def is_configured(self):
+		return bool(self.settings_name)
+
+	@property
+	def settings(self):
+		# controller methods keep the state of a payment on the document, so like production
+		# callers every step works on its own copy
+		return get_settings(self.settings_doctype, self.settings_name, copy=True)
+
+	def prepare(self, reference):
+		"""Called once before the iterations, with the reference document of the payments."""
+
+	@property
+	def steps(self):
+		"""(name, method) of the steps of an iteration, each method is passed the payment."""
+		return []
+
+	def finish(self):
+		"""(name, method) of the steps run once for all the payments, after all the iterations."""
+		return []
+
+	def new_payment(self, reference):
+		return frappe._dict(
+			amount=random.randint(1, 100) * 10,
+			currency=self.currency,
+			title="Benchmark",
+			description="Benchmark payment",
+			reference_doctype=reference.doctype,
+			reference_docname=reference.name,
+			payer_email="benchmark@example.com",
+			payer_name="Benchmark",
+			order_id=reference.name,
+		)
+
+
+class RazorpayFlow(Flow):
+	gateway = "razorpay"
+	settings_doctype = "Razorpay Settings"
+
+	def get_settings_name(self):
+		return self.settings_doctype if frappe.db.get_single_value(self.settings_doctype, "api_key") else None
+
+	@property
+	def steps(self):
+		return [("payment_url", self.get_payment_url), ("callback", self.callback)]
+
+	def get_payment_url(self, payment):
+		url = self.settings.get_payment_url(**payment)
+		payment.token = get_query_param(url, "token")
+
+	def callback(self, payment):
+		self.settings.create_request({"token": payment.token, "razorpay_payment_id": random_id("pay_")})
+
+	def finish(self):
+		from payments.payment_gateways.doctype.razorpay_settings.razorpay_settings import capture_payment
+
+		return [("capture", capture_payment)]
+
+
+class PayPalFlow(Flow):
+	gateway = "paypal"
+	settings_doctype = "PayPal Settings"
+	currency = "USD"
+
+	def get_settings_name(self):
+		return (
+			self.settings_doctype
+			if frappe.db.get_single_value(self.settings_doctype, "api_username")
+			else None
+		)
+
+	@property
+	def steps(self):
+		return [
+			("payment_url", self.get_payment_url),
+			("checkout_details", self.get_checkout_details),
+			("confirm", self.confirm),
+		]
+
+	def get_payment_url(self, payment):
+		url = self.settings.get_payment_url(**payment)
+		payment.token = get_query_param(url, "token")
+
+	def get_checkout_details(self, payment):
+		from payments.payment_gateways.doctype.paypal_settings.paypal_settings import (
+			get_express_checkout_details,
+		)
+
+		get_express_checkout_details(payment.token)
+
+	def confirm(self, payment):
+		from payments.payment_gateways.doctype.paypal_settings.paypal_settings import confirm_payment
+
+		confirm_payment(payment.token)
+
+
+class PaytmFlow(Flow):
+	gateway = "paytm"
+	settings_doctype = "Paytm Settings"
+
+	def get_settings_name(self):
+		return (
+			self.settings_doctype
+			if frappe.db.get_single_value(self.settings_doctype, "merchant_id")
+			else None
+		)
+
+	@property
+	def steps(self):
+		return [("payment_url", self.get_payment_url), ("callback", self.callback)]
+
+	def get_payment_url(self, payment):
+		url = self.settings.get_payment_url(**payment)
+		payment.order_id = get_query_param(url, "order_id")
+
+	def callback(self, payment):
+		from paytmchecksum import generateSignature
+
+		from payments.payment_gateways.doctype.paytm_settings.paytm_settings import (
+			get_paytm_config,
+			verify_transaction,
+		)
+
+		params = {
+			"ORDERID": payment.order_id,
+			"TXNAMOUNT": str(payment.amount),
+			"STATUS": "TXN_SUCCESS",
+			"RESPCODE": "01",
+		}
+		params["CHECKSUMHASH"] = generateSignature(params, get_paytm_config().merchant_key)
+		verify_transaction(**params)
+
+
+class MpesaFlow(Flow):
+	gateway = "mpesa"
+	settings_doctype = "Mpesa Settings"
+	currency = "KES"
+
+	@property
+	def steps(self):
+		return [("stk_push", self.stk_push), ("callback", self.callback)]
+
+	def stk_push(self, payment):
+		responses = self.settings.request_for_payment(
+			**payment,
+			request_amount=payment.amount,
+			sender="0700000000",
+			payment_reference=payment.reference_docname,
+		)
+		payment.checkout_ids = [response.CheckoutRequestID for response in responses]
+
+	def callback(self, payment):
+		from payments.payment_gateways.doctype.mpesa_settings.mpesa_settings import verify_transaction
+
+		for checkout_id in payment.checkout_ids:
+			verify_transaction(
+				Body={
+					"stkCallback": {
+						"MerchantRequestID": random_id(""),
+						"CheckoutRequestID": checkout_id,
+						"ResultCode": 0,
+						"ResultDesc": "The service request is processed successfully.",
+						"CallbackMetadata": {
+							"Item": [
+								{"Name": "Amount", "Value": payment.amount},
+								{"Name": "MpesaReceiptNumber", "Value": random_id("R")},
+								{"Name": "PhoneNumber", "Value": 254700000000},
+							]
+						},
+					}
+				}
+			)
+
+
+class GoCardlessFlow(Flow):
+	gateway = "gocardless"
+	settings_doctype = "GoCardless Settings"
+	currency = "EUR"
+
+	def __init__(self):
+		super().__init__()
+		self.payment_request = None
+		self.mandate = None
+
+	def prepare(self, reference):
+		if reference.doctype != "Payment Request":
+			return
+
+		customer = frappe.db.get_value(reference.reference_doctype, reference.reference_name, "customer_name")
+		self.mandate = frappe.db.get_value(
+			"GoCardless Mandate", {"customer": customer, "disabled": 0}, "mandate"
+		)
+		if self.mandate:
+			self.payment_request = reference
+		else:
+			print(f"Skipping the GoCardless charge: {customer} has no GoCardless Mandate")
+
+	@property
+	def steps(self):
+		steps = [("payment_url", self.get_payment_url), ("webhook", self.webhook)]
+		if self.payment_request:
+			steps.append(("charge", self.charge))
+		return steps
+
+	def get_payment_url(self, payment):
+		self.settings.get_payment_url(**payment)
+
+	def charge(self, payment):
+		# like a submitted Payment Request, the mandate status is read from the cache kept by webhooks
+		if self.settings.on_payment_request_submission(self.payment_request):
+			raise Exception(f"GoCardless Mandate {self.mandate} is not active")
+
+	def webhook(self, payment):
+		from werkzeug.test import EnvironBuilder
+
+		from payments.payment_gateways.doctype.gocardless_settings import webhooks
+
+		body = json.dumps(
+			{
+				"events": [
+					{
+						"id": random_id("EV"),
+						"resource_type": "mandates",
+						"action": "active",
+						"links": {"mandate": self.mandate or random_id("MD")},
+					}
+				]
+			}
+		).encode()
+		signature = hmac.new(self.settings.webhooks_secret.encode(), body, hashlib.sha256).hexdigest()
+
+		frappe.local.request = EnvironBuilder(
+			method="POST",
+			data=body,
+			headers={"Webhook-Signature": signature},
+			query_string={"gateway": self.settings_name},
+		).get_request()
+		try:
+			webhooks()
+		finally:
+			frappe.local.request = None
+
+	def is_configured(self):
+		return super().is_configured() and bool(self.settings.webhooks_secret)
+
+
+FLOWS = {flow.gateway: flow for flow in (RazorpayFlow, PayPalFlow, PaytmFlow, MpesaFlow, GoCardlessFlow)}
+
+
+def run(
+	gateways=None,
+	concurrency=8,
+	iterations=100,
+	latency=0.05,
+	error_rate=0.0,
+	reference_doctype=None,
+	reference_docname=None,
+):
+	if not frappe.conf.allow_tests:
+		frappe.throw("Benchmarks can only run on sites with allow_tests enabled")
+
+	flows = []
+	for gateway in gateways or FLOWS:
+		flow = FLOWS[gateway]()
+		if flow.is_configured():
+			flows.append(flow)
+		else:
+			print(f"Skipping {gateway}: {flow.settings_doctype} is not configured")
+
+	reference = get_reference(reference_doctype, reference_docname)
+
+	results = {}
+	with StubServers([flow.gateway for flow in flows], latency=latency, error_rate=error_rate) as stubs:
+		set_host_overrides(stubs.host_overrides)
+		try:
+			for flow in flows:
+				results[flow.gateway] = run_flow(flow, reference, cint(concurrency), cint(iterations))
+		finally:
+			set_host_overrides({})
+
+	print_report(results)
+	return results
+
+
+def get_reference(reference_doctype, reference_docname):
+	if reference_doctype and reference_docname:
+		return frappe.get_doc(reference_doctype, reference_docname)
+
+	reference = frappe.get_doc({"doctype": "ToDo", "description": "Payments benchmark"}).insert()
+	frappe.db.commit()  # nosemgrep
+	return reference
+
+
+def run_flow(flow, reference, concurrency, iterations):
+	flow.prepare(reference)
+
+	tasks = queue.Queue()
+	for _ in range(iterations):
+		tasks.put(flow.new_payment(reference))
+
+	timings = []
+	threads = [
+		threading.Thread(
+			target=run_worker, args=(frappe.local.site, frappe.local.sites_path, flow, tasks, timings)
+		)
+		for _ in range(concurrency)
+	]
+
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	duration = time.perf_counter() - start
+
+	for step, method in flow.finish():
+		timings.append(run_step(step, method))
+
+	return summarize(timings, iterations, duration)
+
+
+def run_worker(site, sites_path, flow, tasks, timings):
+	frappe.init(site=site, sites_path=sites_path)
+	frappe.connect()
+	frappe.set_user("Administrator")
+
+	try:
+		while True:
+			try:
+				payment = tasks.get_nowait()
+			except queue.Empty:
+				return
+
+			for step, method in flow.steps:
+				timing = run_step(step, method, payment)
+				timings.append(timing)
+				if not timing[3]:
+					break
+	finally:
+		frappe.destroy()
+
+
+def run_step(step, method, *args):
+	"""Run a step like a request would, returns (step, seconds, queries, succeeded)."""
+	frappe.local.response = frappe._dict()
+
+	start = time.perf_counter()
+	with count_queries() as queries:
+		try:
+			method(*args)
+			frappe.db.commit()  # nosemgrep
+			succeeded = True
+		except Exception:
+			frappe.db.rollback()
+			succeeded = False
+
+	return step, time.perf_counter() - start, queries.count, succeeded
+
+
+def summarize(timings, iterations, duration):
+	steps = {}
+	for step, elapsed, queries, succeeded in timings:
+		stats = steps.setdefault(step, frappe._dict(latencies=[], queries=0, errors=0))
+		stats.latencies.append(elapsed)
+		stats.queries += queries
+		stats.errors += not succeeded
+
+	for stats in steps.values():
+		latencies = sorted(stats.pop("latencies"))
+		stats.count = len(latencies)
+		stats.p50 = percentile(latencies, 50)
+		stats.p99 = percentile(latencies, 99)
+		stats.queries = round(stats.queries / stats.count, 1)
+
+	return frappe._dict(
+		iterations=iterations,
+		duration=round(duration, 3),
+		throughput=round(iterations / duration, 2) if duration else 0,
+		steps=steps,
+	)
+
+
+def percentile(values, percent):
+	index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+	return round(values[index] * 1000, 2)
+
+
+def print_report(results):
+	for gateway, result in results.items():
+		print(f"\n{gateway}: {result.iterations} iterations in {result.duration}s, {result.throughput}/s")
+		print(f"  {'step':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'queries':>10}")
+		for step, stats in result.steps.items():
+			print(
+				f"  {step:<20}{stats.count:>8}{stats.errors:>8}{stats.p50:>10}{stats.p99:>10}{stats.queries:>10}"
+			)
+
+
+def get_query_param(url, param):
+	return parse_qs(urlsplit(url).query)[param][0]
@@ -0,0 +1,84 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Time and memory it takes a fresh worker to import the gateway controllers.
+
+	bench --site test_site execute payments.tests.import_benchmark.run --kwargs "{'runs': 5}"
+
+Each measurement is made in a new interpreter, so nothing is already imported. The
+controllers are imported the way a worker does, SDKs being loaded on first use, then
+again with every SDK imported up front as they used to be. The difference is what a
+worker that never calls a gateway saves.
+"""
+
+import json
+import subprocess
+import sys
+from statistics import median
+
+CONTROLLERS = (
+	"payments.payment_gateways.doctype.braintree_settings.braintree_settings",
+	"payments.payment_gateways.doctype.gocardless_settings.gocardless_settings",
+	"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings",
+	"payments.payment_gateways.doctype.paytm_settings.paytm_settings",
+	"payments.payment_gateways.stripe_integration",
+)
+SDKS = ("braintree", "gocardless_pro", "razorpay", "paytmchecksum", "stripe")
+
+MEASURE = """
+import importlib, json, resource, sys, time
+
+import frappe
+
+modules = json.loads(sys.argv[1])
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+for module in modules:
+	importlib.import_module(module)
+
+print(json.dumps({
+	"seconds": time.perf_counter() - start,
+	"rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+	"sdks": [sdk for sdk in json.loads(sys.argv[2]) if sdk in sys.modules],
+}))
+"""
+
+
+def run(runs=5):
+	"""Print and return the median import time and RSS growth, lazy and eager."""
+	results = {
+		"lazy": measure(CONTROLLERS, runs),
+		"eager": measure(SDKS + CONTROLLERS, runs),
+	}
+
+	for mode, result in results.items():
+		print(
+			f"{mode:<6} {result['seconds'] * 1000:>8.1f} ms {result['rss_kb'] / 1024:>8.1f} MiB"
+			f"  SDKs imported: {', '.join(result['sdks']) or '-'}"
+		)
+
+	lazy, eager = results["lazy"], results["eager"]
+	print(
+		f"saved  {(eager['seconds'] - lazy['seconds']) * 1000:>8.1f} ms"
+		f" {(eager['rss_kb'] - lazy['rss_kb']) / 1024:>8.1f} MiB"
+	)
+
+	return results
+
+
+def measure(modules, runs):
+	samples = [import_in_new_interpreter(modules) for _ in range(runs)]
+	return {
+		"seconds": median(s["seconds"] for s in samples),
+		"rss_kb": median(s["rss_kb"] for s in samples),
+		"sdks": samples[-1]["sdks"],
+	}
+
+
+def import_in_new_interpreter(modules):
+	output = subprocess.check_output(
+		[sys.executable, "-c", MEASURE, json.dumps(list(modules)), json.dumps(SDKS)],
+		text=True,
+	)
+	return json.loads(output.strip().splitlines()[-1])
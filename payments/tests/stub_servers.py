@@ -0,0 +1,194 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Local HTTP stand-ins for the payment gateway APIs, used by the benchmarks.
+
+Every stub answers the endpoints the app calls with a canned successful response, after
+`latency` seconds. A share of the requests given by `error_rate` fails with a 503 instead.
+
+	with StubServers(latency=0.05, error_rate=0.01) as stubs:
+		set_host_overrides(stubs.host_overrides)
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+# hosts of the sandbox and live APIs that each stub stands in for
+GATEWAY_HOSTS = {
+	"razorpay": ("api.razorpay.com",),
+	"paypal": ("api-3t.sandbox.paypal.com", "api-3t.paypal.com"),
+	"paytm": ("securegw-stage.paytm.in", "securegw.paytm.in"),
+	"mpesa": ("sandbox.safaricom.co.ke", "api.safaricom.co.ke"),
+	"gocardless": ("api-sandbox.gocardless.com", "api.gocardless.com"),
+}
+
+
+def random_id(prefix):
+	return f"{prefix}{random.getrandbits(48):012x}"
+
+
+def razorpay_payment(match, body):
+	return {"id": match["id"], "entity": "payment", "status": "authorized", "amount": 100}
+
+
+def razorpay_capture(match, body):
+	return {"id": match["id"], "entity": "payment", "status": "captured", "amount": 100}
+
+
+def razorpay_order(match, body):
+	return {"id": random_id("order_"), "entity": "order", "status": "created"}
+
+
+def razorpay_list(match, body):
+	return {"entity": "collection", "count": 0, "items": []}
+
+
+def paypal_nvp(match, body):
+	return urlencode(
+		{
+			"ACK": "Success",
+			"TOKEN": random_id("EC-"),
+			"CORRELATIONID": random_id(""),
+			"PAYERID": random_id("PAYER"),
+			"PAYMENTINFO_0_TRANSACTIONID": random_id("TXN"),
+			"PROFILEID": random_id("I-"),
+			"PROFILESTATUS": "ActiveProfile",
+		}
+	)
+
+
+def paytm_status(match, body):
+	order_id = json.loads(body or "{}").get("ORDERID")
+	return {"ORDERID": order_id, "STATUS": "TXN_SUCCESS", "RESPCODE": "01", "TXNID": random_id("")}
+
+
+def mpesa_token(match, body):
+	return {"access_token": random_id("token"), "expires_in": "3599"}
+
+
+def mpesa_stk_push(match, body):
+	return {
+		"MerchantRequestID": random_id(""),
+		"CheckoutRequestID": random_id("ws_CO_"),
+		"ResponseCode": "0",
+		"ResponseDescription": "Success. Request accepted for processing",
+		"CustomerMessage": "Success. Request accepted for processing",
+	}
+
+
+def gocardless_mandate(match, body):
+	return {"mandates": {"id": match["id"], "status": "active", "links": {"customer": random_id("CU")}}}
+
+
+def gocardless_payment(match, body):
+	return {"payments": {"id": random_id("PM"), "status": "pending_submission", "amount": 100}}
+
+
+ROUTES = {
+	"razorpay": [
+		("GET", r"/v1/payments/(?P<id>[^/]+)", razorpay_payment),
+		("POST", r"/v1/payments/(?P<id>[^/]+)/capture", razorpay_capture),
+		("GET", r"/v1/payments", razorpay_list),
+		("POST", r"/v1/orders", razorpay_order),
+	],
+	"paypal": [("POST", r"/nvp", paypal_nvp)],
+	"paytm": [("POST", r"/order/status", paytm_status)],
+	"mpesa": [
+		("GET", r"/oauth/v1/generate", mpesa_token),
+		("POST", r"/mpesa/stkpush/v1/processrequest", mpesa_stk_push),
+	],
+	"gocardless": [
+		("GET", r"/mandates/(?P<id>[^/]+)", gocardless_mandate),
+		("POST", r"/payments", gocardless_payment),
+	],
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		self.respond("GET")
+
+	def do_POST(self):
+		self.respond("POST")
+
+	def respond(self, method):
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length).decode() if length else ""
+		path = self.path.split("?", 1)[0]
+
+		time.sleep(self.server.latency)
+		self.server.requests += 1
+
+		if random.random() < self.server.error_rate:
+			return self.send(503, {"error": "Service Unavailable"})
+
+		for route_method, pattern, handler in ROUTES[self.server.gateway]:
+			if route_method == method and (match := re.fullmatch(pattern, path)):
+				return self.send(200, handler(match.groupdict(), body))
+
+		self.send(404, {"error": f"{method} {path} is not stubbed"})
+
+	def send(self, status, payload):
+		if isinstance(payload, str):
+			content_type, body = "text/plain; charset=utf-8", payload.encode()
+		else:
+			content_type, body = "application/json", json.dumps(payload).encode()
+
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class StubServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, gateway, latency=0.0, error_rate=0.0):
+		super().__init__(("127.0.0.1", 0), StubHandler)
+		self.gateway = gateway
+		self.latency = latency
+		self.error_rate = error_rate
+		self.requests = 0
+
+	@property
+	def url(self):
+		return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubServers:
+	"""Start a stub for every gateway in `gateways` (all by default) on a free local port."""
+
+	def __init__(self, gateways=None, latency=0.0, error_rate=0.0):
+		self.servers = {
+			gateway: StubServer(gateway, latency=latency, error_rate=error_rate)
+			for gateway in (gateways or ROUTES)
+		}
+
+	@property
+	def host_overrides(self):
+		return {
+			host: server.url for gateway, server in self.servers.items() for host in GATEWAY_HOSTS[gateway]
+		}
+
+	def __enter__(self):
+		for server in self.servers.values():
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+
+		return self
+
+	def __exit__(self, *args):
+		for server in self.servers.values():
+			server.shutdown()
+			server.server_close()
@@ -0,0 +1,28 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+import unittest
+from unittest.mock import Mock
+
+from payments.utils.client_cache import get_client
+
+
+class TestClientCache(unittest.TestCase):
+	def test_client_is_rebuilt_when_the_credentials_change(self):
+		make_client = Mock(side_effect=lambda: object())
+
+		first = get_client("test", "_Test Account", ("key", "secret"), make_client)
+		self.assertIs(get_client("test", "_Test Account", ("key", "secret"), make_client), first)
+		self.assertIsNot(get_client("test", "_Test Account", ("key", "rotated"), make_client), first)
+		self.assertEqual(make_client.call_count, 2)
+
+	def test_clients_are_kept_per_gateway_and_account(self):
+		make_client = Mock(side_effect=lambda: object())
+
+		clients = {
+			get_client(gateway, name, "secret", make_client)
+			for gateway in ("test", "other")
+			for name in ("_Test Account", "_Test Other Account")
+		}
+
+		self.assertEqual(len(clients), 4)
@@ -0,0 +1,94 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+import unittest
+
+import frappe
+
+from payments.utils.idempotency import idempotent
+
+SUCCESS = "payment-success?doctype=Payment+Request&docname=ACC-PRQ-0001"
+FAILURE = "payment-failed"
+
+
+class TestIdempotent(unittest.TestCase):
+	def setUp(self):
+		self.response = frappe.local.response
+		frappe.local.response = frappe._dict()
+		self.token = frappe.generate_hash()
+		self.calls = 0
+		self.outcomes = []
+
+		@idempotent("test.make_payment", "token")
+		def make_payment(token):
+			self.calls += 1
+			outcome = self.outcomes.pop(0)
+			if isinstance(outcome, Exception):
+				raise outcome
+			return {"redirect_to": outcome, "status": 200 if outcome == SUCCESS else 401}
+
+		@idempotent("test.confirm_payment", "token")
+		def confirm_payment(token):
+			self.calls += 1
+			frappe.local.response["type"] = "redirect"
+			frappe.local.response["location"] = self.outcomes.pop(0)
+
+		self.make_payment = make_payment
+		self.confirm_payment = confirm_payment
+
+	def tearDown(self):
+		frappe.local.response = self.response
+		frappe.cache().delete_keys("payments_idempotency:test.")
+
+	def test_duplicate_is_replayed(self):
+		self.outcomes = [SUCCESS]
+
+		first = self.make_payment(self.token)
+		duplicate = self.make_payment(token=self.token)
+
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(duplicate, first)
+
+	def test_redirect_of_duplicate_is_replayed(self):
+		self.outcomes = [SUCCESS]
+
+		self.confirm_payment(self.token)
+		frappe.local.response = frappe._dict()
+		self.confirm_payment(self.token)
+
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(frappe.local.response.type, "redirect")
+		self.assertEqual(frappe.local.response.location, SUCCESS)
+
+	def test_retry_after_failure_is_run_again(self):
+		self.outcomes = [FAILURE, SUCCESS]
+
+		self.assertEqual(self.make_payment(self.token)["redirect_to"], FAILURE)
+		self.assertEqual(self.make_payment(self.token)["redirect_to"], SUCCESS)
+		# the successful outcome is the one kept
+		self.assertEqual(self.make_payment(self.token)["redirect_to"], SUCCESS)
+		self.assertEqual(self.calls, 2)
+
+	def test_retry_after_failed_redirect_is_run_again(self):
+		self.outcomes = [FAILURE, SUCCESS]
+
+		self.confirm_payment(self.token)
+		self.confirm_payment(self.token)
+
+		self.assertEqual(self.calls, 2)
+		self.assertEqual(frappe.local.response.location, SUCCESS)
+
+	def test_retry_after_error_is_run_again(self):
+		self.outcomes = [frappe.ValidationError("Gateway unreachable"), SUCCESS]
+
+		self.assertRaises(frappe.ValidationError, self.make_payment, self.token)
+		self.assertEqual(self.make_payment(self.token)["redirect_to"], SUCCESS)
+		self.assertEqual(self.calls, 2)
+
+	def test_calls_without_key_are_not_deduplicated(self):
+		self.outcomes = [SUCCESS, SUCCESS]
+
+		self.make_payment(None)
+		self.make_payment(None)
+
+		self.assertEqual(self.calls, 2)
@@ -1,8 +1,10 @@
 from payments.utils.utils import (
 	before_install,
+	bulk_create_request_logs,
 	create_payment_gateway,
 	delete_custom_fields,
 	erpnext_app_import_guard,
+	get_gateway_details,
 	get_payment_gateway_controller,
 	make_custom_fields,
 )
@@ -0,0 +1,26 @@
+"""
+Process wide cache of the API clients of payment gateway accounts.
+
+A client is kept per site and account for the lifetime of the process, so the connections and
+configuration it holds are reused by every request served by the process. It is built again
+when the credentials it was built with change, e.g. after the settings are saved.
+"""
+
+from collections.abc import Callable
+
+import frappe
+
+_clients = {}
+
+
+def get_client(gateway: str, name: str, credentials, make_client: Callable):
+	"""Return the cached client of the account `name`, built by `make_client` for `credentials`."""
+	key = (frappe.local.site, gateway, name)
+
+	cached = _clients.get(key)
+	if cached and cached[0] == credentials:
+		return cached[1]
+
+	client = make_client()
+	_clients[key] = (credentials, client)
+	return client
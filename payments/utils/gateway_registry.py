@@ -0,0 +1,132 @@
+"""
+Registry of the payment gateways of a site.
+
+Maps every Payment Gateway to the settings document it is served by and to what its
+controller can do, so that routing a payment to its controller is a dictionary lookup.
+The registry is built once, kept in redis, and cleared whenever a Payment Gateway or a
+settings document changes.
+
+The currency index derived from it answers which gateways can take a payment in a
+currency without loading any settings document, see `get_gateways_for_currency`. Only
+gateways whose settings are configured are in it.
+"""
+
+import frappe
+from frappe.model import no_value_fields, table_fields
+from frappe.model.base_document import get_controller
+from frappe.utils import flt
+
+REGISTRY_KEY = "payments_gateway_registry"
+CURRENCY_INDEX_KEY = "payments_gateway_currency_index"
+# capability: method of the settings controller that provides it
+CAPABILITIES = {
+	"checkout": "get_payment_url",
+	"payment_request_submission": "on_payment_request_submission",
+	"phone_payment": "request_for_payment",
+}
+
+
+def get_gateway(payment_gateway: str) -> frappe._dict | None:
+	"""Entry of the registry for the Payment Gateway, None if there is no such gateway.
+
+	An entry has the `settings` doctype and `controller` name of the settings document,
+	whether it is `enabled`, i.e. the settings document exists and has all its mandatory
+	fields set, the `capabilities` of the controller, the currencies it supports and the
+	minimum amount of a transaction by currency, for the currencies that have one.
+	"""
+	entry = get_registry().get(payment_gateway)
+	return frappe._dict(entry) if entry else None
+
+
+def get_registry() -> dict:
+	return frappe.cache().get_value(REGISTRY_KEY, build_registry)
+
+
+def build_registry() -> dict:
+	registry = {}
+	for gateway in frappe.get_all(
+		"Payment Gateway", fields=["name", "gateway_settings", "gateway_controller"]
+	):
+		# gateways created without a controller are served by the single "<gateway> Settings"
+		if gateway.gateway_controller:
+			settings, controller = gateway.gateway_settings, gateway.gateway_controller
+		else:
+			settings = controller = f"{gateway.name} Settings"
+
+		try:
+			controller_class = get_controller(settings)
+		except Exception:
+			# settings of an app that is no longer installed
+			continue
+
+		registry[gateway.name] = {
+			"settings": settings,
+			"controller": controller,
+			"enabled": is_configured(settings, controller),
+			"capabilities": [
+				capability
+				for capability, method in CAPABILITIES.items()
+				if callable(getattr(controller_class, method, None))
+			],
+			"supported_currencies": sorted(getattr(controller_class, "supported_currencies", ())),
+			"minimum_amounts": dict(getattr(controller_class, "currency_wise_minimum_charge_amount", {})),
+		}
+
+	return registry
+
+
+def is_configured(settings, controller):
+	meta = frappe.get_meta(settings)
+	mandatory = [
+		df.fieldname
+		for df in meta.fields
+		if df.reqd and df.fieldtype not in no_value_fields and df.fieldtype not in table_fields
+	]
+	if not mandatory:
+		return bool(meta.issingle or frappe.db.exists(settings, controller))
+
+	# password fields hold a placeholder when they are set
+	values = frappe.db.get_value(settings, controller, mandatory, as_dict=True) or {}
+	return all(values.get(field) for field in mandatory)
+
+
+def get_gateways_for_currency(currency: str, amount: float | None = None) -> list[str]:
+	"""Payment Gateways that can take a payment in `currency`, of `amount` if given."""
+	gateways = get_currency_index().get(currency)
+	if not gateways:
+		return []
+
+	if amount is not None:
+		registry = get_registry()
+		gateways = [
+			gateway
+			for gateway in gateways
+			if flt(amount) >= registry[gateway]["minimum_amounts"].get(currency, 0)
+		]
+
+	return sorted(gateways)
+
+
+def supports_currency(payment_gateway: str, currency: str) -> bool:
+	return payment_gateway in get_currency_index().get(currency, ())
+
+
+def get_currency_index() -> dict[str, frozenset]:
+	"""Names of the Payment Gateways that support each currency."""
+	return frappe.cache().get_value(CURRENCY_INDEX_KEY, build_currency_index)
+
+
+def build_currency_index() -> dict[str, frozenset]:
+	gateways_by_currency = {}
+	for gateway, entry in get_registry().items():
+		if not entry["enabled"]:
+			continue
+
+		for currency in entry["supported_currencies"]:
+			gateways_by_currency.setdefault(currency, set()).add(gateway)
+
+	return {currency: frozenset(gateways) for currency, gateways in gateways_by_currency.items()}
+
+
+def clear_registry():
+	frappe.cache().delete_value([REGISTRY_KEY, CURRENCY_INDEX_KEY])
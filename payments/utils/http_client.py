@@ -0,0 +1,177 @@
+"""
+Pooled HTTP sessions for the outbound calls made by payment gateways.
+
+A `requests.Session` is kept per gateway for the lifetime of the process, so connections
+and TLS sessions to the gateway's hosts are kept alive and reused between requests.
+Every request has a connect and read timeout.
+
+Site config:
+
+	payments_http_timeout: [connect, read] timeout in seconds (default [5, 30])
+	<gateway>_http_timeout: timeout for a single gateway, e.g. "razorpay_http_timeout"
+	payments_http_pool_size: connections kept open per host (default 10)
+	payments_http_host_overrides: {host: base url} to send a gateway's requests elsewhere,
+		e.g. {"api.razorpay.com": "http://127.0.0.1:8001"} to run against a local stand-in
+
+`request` only uses `frappe.local` when it is available, so it can also be called from
+worker threads. `make_request` behaves like `frappe.integrations.utils.make_request`.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs, urlsplit
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_POOL_SIZE = 10
+
+_sessions = {}
+_host_overrides = {}
+_stats = defaultdict(lambda: {"requests": 0, "errors": 0, "time": 0.0})
+_lock = threading.Lock()
+_upstream = threading.local()
+
+
+def get_session(gateway: str) -> requests.Session:
+	"""Return the process wide session for the gateway, creating it on first use."""
+	session = _sessions.get(gateway)
+	if session:
+		return session
+
+	with _lock:
+		if gateway not in _sessions:
+			_sessions[gateway] = _make_session(
+				_get_conf().get("payments_http_pool_size") or DEFAULT_POOL_SIZE
+			)
+
+		return _sessions[gateway]
+
+
+def _make_session(pool_size):
+	# only failed connection attempts are retried, a request that reached the gateway never is
+	adapter = HTTPAdapter(
+		pool_connections=pool_size,
+		pool_maxsize=pool_size,
+		max_retries=Retry(total=None, connect=3, read=0, status=0, redirect=False, backoff_factor=0.1),
+	)
+
+	session = requests.Session()
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	session.hooks["response"].append(_add_upstream_time)
+	return session
+
+
+def _add_upstream_time(response, *args, **kwargs):
+	_upstream.time = get_upstream_time() + response.elapsed.total_seconds()
+
+
+def get_upstream_time() -> float:
+	"""Seconds the current thread has waited on responses from the pooled sessions, ever."""
+	return getattr(_upstream, "time", 0.0)
+
+
+def _get_conf():
+	# worker threads have no site context
+	return getattr(frappe.local, "conf", None) or {}
+
+
+def get_timeout(gateway: str) -> tuple:
+	conf = _get_conf()
+	timeout = conf.get(f"{gateway}_http_timeout") or conf.get("payments_http_timeout") or DEFAULT_TIMEOUT
+	return tuple(timeout) if isinstance(timeout, list | tuple) else timeout
+
+
+def request(gateway: str, method: str, url: str, timeout=None, **kwargs) -> requests.Response:
+	"""Send a request through the gateway's pooled session and return the raw response."""
+	if timeout is None:
+		timeout = get_timeout(gateway)
+
+	start = time.monotonic()
+	failed = True
+	try:
+		response = get_session(gateway).request(method, resolve_url(url), timeout=timeout, **kwargs)
+		failed = response.status_code >= 400
+		return response
+	finally:
+		_record(gateway, time.monotonic() - start, failed)
+
+
+def set_host_overrides(overrides: dict):
+	"""Override hosts for every site served by this process, in addition to the site config."""
+	_host_overrides.clear()
+	_host_overrides.update(overrides)
+
+
+def resolve_url(url: str) -> str:
+	"""Return the url with its scheme and host replaced if the host is overridden."""
+	conf_overrides = _get_conf().get("payments_http_host_overrides")
+	if not (_host_overrides or conf_overrides):
+		return url
+
+	parts = urlsplit(url)
+	base_url = (conf_overrides or {}).get(parts.netloc) or _host_overrides.get(parts.netloc)
+	if not base_url:
+		return url
+
+	return base_url.rstrip("/") + url[len(f"{parts.scheme}://{parts.netloc}") :]
+
+
+def _record(gateway, elapsed, failed):
+	with _lock:
+		stats = _stats[gateway]
+		stats["requests"] += 1
+		stats["errors"] += failed
+		stats["time"] += elapsed
+
+
+def get_stats() -> dict:
+	"""Requests sent, failed and total seconds spent per gateway in this process."""
+	with _lock:
+		return {gateway: dict(stats) for gateway, stats in _stats.items()}
+
+
+def make_request(
+	gateway: str, method: str, url: str, auth=None, headers=None, data=None, json=None, params=None
+):
+	try:
+		response = frappe.flags.integration_request = request(
+			gateway,
+			method,
+			url,
+			auth=auth or "",
+			headers=headers or {},
+			data=data or {},
+			json=json,
+			params=params,
+		)
+		response.raise_for_status()
+
+		# Check whether the response has a content-type, before trying to check what it is
+		if content_type := response.headers.get("content-type"):
+			if content_type == "text/plain; charset=utf-8":
+				return parse_qs(response.text)
+			elif content_type.startswith("application/") and content_type.split(";")[0].endswith("json"):
+				return response.json()
+			elif response.text:
+				return response.text
+		return
+	except Exception as exc:
+		if frappe.flags.integration_request_doc:
+			frappe.flags.integration_request_doc.log_error()
+		else:
+			frappe.log_error()
+		raise exc
+
+
+def make_get_request(gateway: str, url: str, **kwargs):
+	return make_request(gateway, "GET", url, **kwargs)
+
+
+def make_post_request(gateway: str, url: str, **kwargs):
+	return make_request(gateway, "POST", url, **kwargs)
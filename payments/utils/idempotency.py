@@ -0,0 +1,137 @@
+"""
+Deduplication of payment callbacks and redirects.
+
+Double clicks, refreshes and gateway retries deliver the same callback several times.
+Handlers wrapped with `idempotent` run once per key (e.g. the gateway's transaction id):
+concurrent duplicates wait on a redis lock for the first one to finish, and later ones get
+its result, and the redirect it set up, straight from redis.
+
+Only successful outcomes are cached, i.e. those that send the customer to the
+payment-success page, by redirecting there or by returning it as `redirect_to`. A handler
+that raises or whose payment failed is run again by the next duplicate, so that a customer
+retrying after a transient error is not sent the first failure again.
+
+Site config:
+
+	payments_idempotency_ttl: seconds results are kept for (default 86400)
+"""
+
+import hashlib
+import inspect
+from functools import wraps
+from urllib.parse import urlparse
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+from redis.exceptions import LockError
+
+DEFAULT_TTL = 24 * 60 * 60
+SUCCESS_PAGE = "payment-success"
+# longest a handler is expected to run, the lock is released after this even if it has not
+LOCK_TIMEOUT = 120
+# how long a duplicate waits for the first call to finish
+LOCK_WAIT = 30
+
+
+def idempotent(namespace: str, *key_args: str):
+	"""Run the decorated handler once per value of its `key_args` arguments.
+
+	Keyword arguments collected by `**kwargs` can be used as key arguments too. Calls
+	missing any of them are not deduplicated.
+	"""
+
+	def decorator(fn):
+		signature = inspect.signature(fn)
+
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			key = get_key(namespace, signature, key_args, args, kwargs)
+			if not key:
+				return fn(*args, **kwargs)
+
+			if (cached := get_result(key)) is not None:
+				return replay(cached)
+
+			cache = frappe.cache()
+			lock = cache.lock(cache.make_key(f"{key}:lock"), timeout=LOCK_TIMEOUT, blocking_timeout=LOCK_WAIT)
+			if not lock.acquire():
+				if (cached := get_result(key)) is not None:
+					return replay(cached)
+
+				frappe.throw(
+					_("This payment is already being processed, please try again in a moment."),
+					exc=frappe.TooManyRequestsError,
+				)
+
+			try:
+				# the call that held the lock may have finished while this one waited
+				if (cached := get_result(key)) is not None:
+					return replay(cached)
+
+				result = fn(*args, **kwargs)
+				store_result(key, result)
+				return result
+			finally:
+				try:
+					lock.release()
+				except LockError:
+					# expired while the handler was running
+					pass
+
+		return wrapper
+
+	return decorator
+
+
+def get_key(namespace, signature, key_args, args, kwargs):
+	arguments = signature.bind_partial(*args, **kwargs).arguments
+	var_kwargs = next(
+		(
+			value
+			for name, value in arguments.items()
+			if signature.parameters[name].kind is inspect.Parameter.VAR_KEYWORD
+		),
+		{},
+	)
+
+	values = [arguments.get(name, var_kwargs.get(name)) for name in key_args]
+	if not all(values):
+		return None
+
+	# the key can be made of secrets or long payloads, only its hash is stored
+	digest = hashlib.sha256("\0".join(str(value) for value in values).encode()).hexdigest()
+	return f"payments_idempotency:{namespace}:{digest}"
+
+
+def get_result(key):
+	return frappe.cache().get_value(key, expires=True)
+
+
+def store_result(key, result):
+	response = frappe.local.response
+	redirect = (
+		{"type": "redirect", "location": response.get("location")}
+		if response.get("type") == "redirect"
+		else None
+	)
+	if response.get("type") == "page" or not succeeded(result, redirect):
+		return
+
+	ttl = cint(frappe.conf.payments_idempotency_ttl) or DEFAULT_TTL
+	frappe.cache().set_value(key, {"result": result, "redirect": redirect}, expires_in_sec=ttl)
+
+
+def succeeded(result, redirect):
+	location = redirect["location"] if redirect else None
+	if not location and isinstance(result, dict):
+		location = result.get("redirect_to")
+
+	return bool(location) and urlparse(location).path.strip("/").endswith(SUCCESS_PAGE)
+
+
+def replay(cached):
+	if cached["redirect"]:
+		frappe.local.response.update(cached["redirect"])
+
+	return cached["result"]
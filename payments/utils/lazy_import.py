@@ -0,0 +1,35 @@
+"""
+Gateway SDKs imported on first use.
+
+Controllers are imported by every worker, whether or not the site uses their gateway, so
+they refer to their SDK through a `LazyModule`. The SDK is only imported when one of its
+attributes is first looked up, i.e. when the gateway actually makes a call.
+
+	braintree = lazy_import("braintree")
+	gateway = braintree.BraintreeGateway(...)  # braintree is imported here
+
+See `payments.tests.import_benchmark` for the time and memory it saves at startup.
+"""
+
+import importlib
+import sys
+
+
+class LazyModule:
+	def __init__(self, name: str):
+		object.__setattr__(self, "_name", name)
+
+	def __getattr__(self, attr):
+		# after the first import this is a lookup in sys.modules
+		return getattr(importlib.import_module(self._name), attr)
+
+	def __setattr__(self, attr, value):
+		setattr(importlib.import_module(self._name), attr, value)
+
+	def __repr__(self):
+		state = "imported" if self._name in sys.modules else "not imported"
+		return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+	return LazyModule(name)
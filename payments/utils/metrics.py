@@ -0,0 +1,184 @@
+"""
+Timings of the payment gateway operations, exported in the Prometheus text format.
+
+Operations are wrapped with `instrumented`, which records for every call its wall time,
+the number of queries sent to the database, the time spent waiting on the gateway's API
+and whether it raised. Measurements are added to redis hashes, one per operation and time
+window, so the exported histograms cover the last `payments_metrics_retention` seconds
+and are shared by every process of the site.
+
+Upstream time is the time to the response headers of the requests sent through the pooled
+sessions of `payments.utils.http_client`, by the thread running the operation.
+
+	GET /api/method/payments.utils.metrics.export
+
+Site config:
+
+	payments_metrics_disabled: do not record anything
+	payments_metrics_window: seconds covered by each window (default 60)
+	payments_metrics_retention: seconds the windows are kept and exported for (default 3600)
+"""
+
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import frappe
+from frappe.utils import cint, flt
+from werkzeug.wrappers import Response
+
+from payments.utils.http_client import get_upstream_time
+
+DEFAULT_WINDOW = 60
+DEFAULT_RETENTION = 60 * 60
+# upper bounds of the duration buckets, in seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+OPERATIONS_KEY = "payments_metrics:operations"
+
+
+def instrumented(operation: str):
+	"""Record the calls of the decorated function as `operation`, e.g. "razorpay.create_request"."""
+
+	def decorator(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			if frappe.conf.payments_metrics_disabled:
+				return fn(*args, **kwargs)
+
+			upstream_start = get_upstream_time()
+			start = time.perf_counter()
+			outcome = "error"
+			with count_queries() as queries:
+				try:
+					result = fn(*args, **kwargs)
+					outcome = "ok"
+					return result
+				finally:
+					record(
+						operation,
+						time.perf_counter() - start,
+						queries.count,
+						get_upstream_time() - upstream_start,
+						outcome,
+					)
+
+		return wrapper
+
+	return decorator
+
+
+@contextmanager
+def count_queries():
+	"""Count the queries sent through the current thread's database connection."""
+	db = frappe.db
+	counter = frappe._dict(count=0)
+	if not db:
+		yield counter
+		return
+
+	sql = db.sql
+
+	def counting_sql(*args, **kwargs):
+		counter.count += 1
+		return sql(*args, **kwargs)
+
+	db.sql = counting_sql
+	try:
+		yield counter
+	finally:
+		db.sql = sql
+
+
+def record(operation, duration, queries, upstream, outcome):
+	"""Add a call of the operation to the current window, failures to record are ignored."""
+	window = cint(frappe.conf.payments_metrics_window) or DEFAULT_WINDOW
+	retention = cint(frappe.conf.payments_metrics_retention) or DEFAULT_RETENTION
+	bucket = next((str(le) for le in BUCKETS if duration <= le), "+Inf")
+
+	try:
+		cache = frappe.cache()
+		key = cache.make_key(get_window_key(operation, int(time.time() // window)))
+		pipeline = cache.pipeline()
+		pipeline.hincrby(key, f"bucket:{bucket}", 1)
+		pipeline.hincrby(key, f"count:{outcome}", 1)
+		pipeline.hincrbyfloat(key, "duration", duration)
+		pipeline.hincrby(key, "queries", queries)
+		pipeline.hincrbyfloat(key, "upstream", upstream)
+		pipeline.expire(key, retention + window)
+		pipeline.sadd(cache.make_key(OPERATIONS_KEY), operation)
+		pipeline.expire(cache.make_key(OPERATIONS_KEY), retention + window)
+		pipeline.execute()
+	except Exception:
+		pass
+
+
+def get_metrics():
+	"""Totals of the windows still retained, by operation."""
+	window = cint(frappe.conf.payments_metrics_window) or DEFAULT_WINDOW
+	retention = cint(frappe.conf.payments_metrics_retention) or DEFAULT_RETENTION
+	current = int(time.time() // window)
+	windows = range(current - retention // window + 1, current + 1)
+
+	cache = frappe.cache()
+	operations = sorted(
+		operation.decode() if isinstance(operation, bytes) else operation
+		for operation in cache.smembers(cache.make_key(OPERATIONS_KEY))
+	)
+
+	pipeline = cache.pipeline()
+	for operation in operations:
+		for w in windows:
+			pipeline.hgetall(cache.make_key(get_window_key(operation, w)))
+	results = iter(pipeline.execute())
+
+	metrics = {}
+	for operation in operations:
+		totals = metrics[operation] = {}
+		for _ in windows:
+			for field, value in next(results).items():
+				field = field.decode() if isinstance(field, bytes) else field
+				totals[field] = totals.get(field, 0) + flt(value)
+
+	return metrics
+
+
+@frappe.whitelist()
+def export():
+	"""Operation metrics in the Prometheus text format."""
+	frappe.only_for("System Manager")
+
+	metrics = get_metrics()
+	lines = [
+		"# HELP payments_operation_duration_seconds Wall time of the payment gateway operations.",
+		"# TYPE payments_operation_duration_seconds histogram",
+	]
+	for operation, totals in metrics.items():
+		labels = f'operation="{operation}"'
+		count = 0
+		for le in (*BUCKETS, "+Inf"):
+			count += totals.get(f"bucket:{le}", 0)
+			lines.append(f'payments_operation_duration_seconds_bucket{{{labels},le="{le}"}} {int(count)}')
+		lines.append(f"payments_operation_duration_seconds_sum{{{labels}}} {totals.get('duration', 0)}")
+		lines.append(f"payments_operation_duration_seconds_count{{{labels}}} {int(count)}")
+
+	for name, field, help_text in (
+		("payments_operation_db_queries", "queries", "Database queries sent by the operations."),
+		("payments_operation_upstream_seconds", "upstream", "Time spent waiting on the gateway APIs."),
+	):
+		lines.append(f"# HELP {name} {help_text}")
+		lines.append(f"# TYPE {name} gauge")
+		for operation, totals in metrics.items():
+			lines.append(f'{name}{{operation="{operation}"}} {totals.get(field, 0)}')
+
+	lines.append("# HELP payments_operation_calls Calls of the operations, by outcome.")
+	lines.append("# TYPE payments_operation_calls gauge")
+	for operation, totals in metrics.items():
+		for outcome in ("ok", "error"):
+			value = int(totals.get(f"count:{outcome}", 0))
+			lines.append(f'payments_operation_calls{{operation="{operation}",outcome="{outcome}"}} {value}')
+
+	return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def get_window_key(operation, window):
+	return f"payments_metrics:{operation}:{window}"
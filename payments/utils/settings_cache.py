@@ -0,0 +1,79 @@
+"""
+Cached access to payment gateway settings.
+
+Settings documents are read through frappe's document cache (request local, backed by redis),
+which frappe clears whenever the document is saved.
+
+Decrypted secrets are never written to redis, they are kept in memory by each process.
+A version stored in redis is bumped by `clear_settings_cache` from the settings' `on_update`
+and `on_trash`, which makes every process decrypt the secrets of that document again on their
+next use.
+"""
+
+import frappe
+
+from payments.utils.gateway_registry import clear_registry
+
+_secrets = {}
+
+
+def get_settings(doctype: str, name: str | None = None, copy: bool = False):
+	"""Return the settings document from frappe's document cache.
+
+	The cached document is shared by everything a request or job does with it. Controller
+	methods that keep the state of a payment on the document (`data`, `integration_request`,
+	`flags`) must be called on a `copy` of it instead, built without querying the database.
+	"""
+	doc = frappe.get_cached_doc(doctype, name or doctype)
+	return frappe.get_doc(doc.as_dict()) if copy else doc
+
+
+def get_password(doc, fieldname: str, raise_exception: bool = False):
+	"""Return the decrypted value of a password field of a settings document."""
+	version = get_version(doc.doctype, doc.name)
+	key = (frappe.local.site, doc.doctype, doc.name, fieldname)
+
+	cached = _secrets.get(key)
+	if cached and cached[0] == version:
+		return cached[1]
+
+	password = doc.get_password(fieldname=fieldname, raise_exception=raise_exception)
+	_secrets[key] = (version, password)
+	return password
+
+
+def get_version(doctype, name):
+	cache = frappe.cache()
+	key = get_version_key(doctype, name)
+
+	version = cache.get_value(key)
+	if not version:
+		version = frappe.generate_hash(length=10)
+		cache.set_value(key, version)
+
+	return version
+
+
+def clear_settings_cache(doc):
+	"""Invalidate the cached document and the secrets of `doc` in all processes."""
+	frappe.clear_document_cache(doc.doctype, doc.name)
+	clear_registry()
+	bump_version(doc.doctype, doc.name)
+
+	# until the transaction commits, other processes still read the old secrets and may cache
+	# them under the new version, so the version is bumped again once the new ones are visible
+	doctype, name = doc.doctype, doc.name
+
+	def clear_after_commit():
+		clear_registry()
+		bump_version(doctype, name)
+
+	frappe.db.after_commit.add(clear_after_commit)
+
+
+def bump_version(doctype, name):
+	frappe.cache().set_value(get_version_key(doctype, name), frappe.generate_hash(length=10))
+
+
+def get_version_key(doctype, name):
+	return f"payments_settings_version:{doctype}:{name}"
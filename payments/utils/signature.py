@@ -0,0 +1,42 @@
+"""
+Verification of HMAC signed webhooks.
+
+The keyed HMAC of a secret is set up once per process and copied for every request,
+instead of hashing the key again each time. When the account a webhook is for is not
+known, the body is read once and fed to the HMAC of every candidate key.
+"""
+
+import hmac
+from functools import lru_cache
+
+CHUNK_SIZE = 64 * 1024
+
+
+@lru_cache(maxsize=1024)
+def get_hmac(key: str, digestmod: str = "sha256"):
+	return hmac.new(key.encode("utf-8"), digestmod=digestmod)
+
+
+def is_valid_signature(signature, keys, body, digestmod="sha256") -> bool:
+	"""Whether `signature` is the hex digest of the HMAC of `body` with any of the `keys`.
+
+	`body` is bytes, or a file-like object such as a request stream which is read in chunks.
+	"""
+	if not signature or not keys:
+		return False
+
+	macs = [get_hmac(key, digestmod).copy() for key in keys]
+	for chunk in iter_chunks(body):
+		for mac in macs:
+			mac.update(chunk)
+
+	return any(hmac.compare_digest(mac.hexdigest(), str(signature)) for mac in macs)
+
+
+def iter_chunks(body):
+	if isinstance(body, bytes | bytearray | memoryview):
+		yield body
+		return
+
+	while chunk := body.read(CHUNK_SIZE):
+		yield chunk
@@ -4,6 +4,9 @@ import click
 import frappe
 from frappe import _
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+from frappe.utils import cint, now
+
+GATEWAY_DETAILS_TTL = 60
 
 
 def validate_integration_request(docname: str | None):
@@ -13,36 +16,143 @@ def validate_integration_request(docname: str | None):
 
 def get_payment_gateway_controller(payment_gateway):
 	"""Return payment gateway controller"""
-	gateway = frappe.get_doc("Payment Gateway", payment_gateway)
-	if gateway.gateway_controller is None:
-		try:
-			return frappe.get_doc(f"{payment_gateway} Settings")
-		except Exception:
-			frappe.throw(_("{0} Settings not found").format(payment_gateway))
+	from payments.utils.gateway_registry import get_gateway
+	from payments.utils.settings_cache import get_settings
+
+	gateway = get_gateway(payment_gateway)
+	if not gateway:
+		frappe.throw(_("{0} Settings not found").format(payment_gateway))
+
+	try:
+		# callers run the payment methods of the controller, which keep their state on it
+		return get_settings(gateway.settings, gateway.controller, copy=True)
+	except Exception:
+		frappe.throw(_("{0} Settings not found").format(payment_gateway))
+
+
+def get_gateway_details(
+	settings_doctype, reference_doctype, reference_docname, payment_gateway=None, fields=()
+):
+	"""Return the payment gateway, its settings and controller and the settings `fields`
+	of the gateway a reference document is paid with, read with a single query.
+
+	Raises `DoesNotExistError` if there is no such reference document. The result is cached
+	for `payments_gateway_details_ttl` seconds (default 60).
+	"""
+	cache = frappe.cache()
+	key = (
+		f"payments_gateway_details:{settings_doctype}:{reference_doctype}:{reference_docname}:"
+		f"{payment_gateway or ''}:{','.join(fields)}"
+	)
+
+	details = cache.get_value(key, expires=True)
+	if details is not None:
+		return frappe._dict(details)
+
+	gateway = frappe.qb.DocType("Payment Gateway")
+	settings = frappe.qb.DocType(settings_doctype)
+
+	if payment_gateway:
+		query = frappe.qb.from_(gateway).where(gateway.name == payment_gateway)
 	else:
-		try:
-			return frappe.get_doc(gateway.gateway_settings, gateway.gateway_controller)
-		except Exception:
-			frappe.throw(_("{0} Settings not found").format(payment_gateway))
+		reference = frappe.qb.DocType(reference_doctype)
+		query = (
+			frappe.qb.from_(reference)
+			.left_join(gateway)
+			.on(gateway.name == reference.payment_gateway)
+			.where(reference.name == reference_docname)
+		)
+
+	query = query.select(
+		gateway.name.as_("payment_gateway"), gateway.gateway_settings, gateway.gateway_controller
+	)
+	if fields:
+		query = (
+			query.left_join(settings)
+			.on(settings.name == gateway.gateway_controller)
+			.select(*(settings[field] for field in fields))
+		)
+
+	result = query.run(as_dict=True)
+	if not result:
+		if payment_gateway:
+			reference_doctype, reference_docname = "Payment Gateway", payment_gateway
+		frappe.throw(
+			_("{0} {1} not found").format(_(reference_doctype), reference_docname), frappe.DoesNotExistError
+		)
+
+	details = result[0]
+	ttl = cint(frappe.conf.payments_gateway_details_ttl) or GATEWAY_DETAILS_TTL
+	cache.set_value(key, details, expires_in_sec=ttl)
+	return details
 
 
 @frappe.whitelist(allow_guest=True, xss_safe=True)
 def get_checkout_url(**kwargs):
+	from payments.utils.gateway_registry import get_gateway
+	from payments.utils.settings_cache import get_settings
+
+	gateway = get_gateway(kwargs.get("payment_gateway") or "")
 	try:
-		if kwargs.get("payment_gateway"):
-			doc = frappe.get_doc("{} Settings".format(kwargs.get("payment_gateway")))
-			return doc.get_payment_url(**kwargs)
-		else:
-			raise Exception
+		if gateway and gateway.enabled and "checkout" in gateway.capabilities:
+			return get_settings(gateway.settings, gateway.controller, copy=True).get_payment_url(**kwargs)
 	except Exception:
-		frappe.respond_as_web_page(
-			_("Something went wrong"),
-			_(
-				"Looks like something is wrong with this site's payment gateway configuration. No payment has been made."
-			),
-			indicator_color="red",
-			http_status_code=frappe.ValidationError.http_status_code,
+		frappe.log_error("Payment Gateway: Unable to get the checkout url")
+
+	frappe.respond_as_web_page(
+		_("Something went wrong"),
+		_(
+			"Looks like something is wrong with this site's payment gateway configuration. No payment has been made."
+		),
+		indicator_color="red",
+		http_status_code=frappe.ValidationError.http_status_code,
+	)
+
+
+def bulk_create_request_logs(request_logs, service_name, is_remote_request=0):
+	"""Insert Integration Requests with a single query.
+
+	`request_logs` is a list of `(name, data, error)` tuples. Rows are written like
+	`create_request_log` would write them, but without running any document hooks.
+	Names that already exist are skipped.
+	"""
+	if not request_logs:
+		return
+
+	timestamp = now()
+	fields = (
+		"name",
+		"creation",
+		"modified",
+		"owner",
+		"modified_by",
+		"integration_request_service",
+		"is_remote_request",
+		"status",
+		"data",
+		"error",
+		"reference_doctype",
+		"reference_docname",
+	)
+	values = [
+		(
+			name,
+			timestamp,
+			timestamp,
+			frappe.session.user,
+			frappe.session.user,
+			service_name,
+			is_remote_request,
+			"Queued",
+			frappe.as_json(data, indent=4),
+			frappe.as_json(error, indent=4) if error else None,
+			data.get("reference_doctype"),
+			data.get("reference_docname"),
 		)
+		for name, data, error in request_logs
+	]
+
+	frappe.db.bulk_insert("Integration Request", fields, values, ignore_duplicates=True)
 
 
 def create_payment_gateway(gateway, settings=None, controller=None):